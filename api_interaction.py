@@ -1,22 +1,296 @@
 import requests
 import logging
+import asyncio
+import threading
+import random
+import time
+import json
 import os
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from cache import completion_key
+import tracing
 
-def interact_with_model(model, messages):
-    """Interact with the specified OpenAI GPT model."""
-    # Fetch the API key from environment variables each time the function is called
-    headers = {
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout) + ((httpx.TransportError,) if httpx else ())
+
+def build_headers():
+    """Build the OpenAI request headers, fetching the API key from environment variables."""
+    return {
         "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
         "Content-Type": "application/json",
     }
+
+def get_retry_after(response):
+    """Return the server-requested retry delay in seconds, or None if the response does not specify one."""
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class StreamInterrupted(Exception):
+    """Raised by stream_model_response when a reply breaks off after some of it has been streamed."""
+
+class OpenAIClient:
+    """A shared HTTP client for the OpenAI API with a keep-alive connection pool and retries.
+
+    Settings come from the environment: OPENAI_BASE_URL, OPENAI_CONNECT_TIMEOUT,
+    OPENAI_READ_TIMEOUT, OPENAI_MAX_RETRIES, OPENAI_POOL_SIZE and OPENAI_HTTP2
+    (set to 1 to use HTTP/2, which requires the optional httpx[http2] package).
+    """
+
+    def __init__(self):
+        self.base_url = os.getenv("OPENAI_BASE_URL", OPENAI_BASE_URL).rstrip("/")
+        self.connect_timeout = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+        self.read_timeout = float(os.getenv("OPENAI_READ_TIMEOUT", "120"))
+        self.max_retries = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+        self.backoff_base = 0.5
+        self.backoff_cap = 20.0
+        self.keepalive_seconds = 30.0
+        self.last_used = 0.0
+        self.header_listeners = []
+        self.first_token_listeners = []
+        self.headers = build_headers()
+        pool_size = int(os.getenv("OPENAI_POOL_SIZE", "10"))
+
+        self.http2 = os.getenv("OPENAI_HTTP2") == "1" and httpx is not None
+        if os.getenv("OPENAI_HTTP2") == "1" and httpx is None:
+            logging.warning("OPENAI_HTTP2 is set but httpx is not installed; falling back to HTTP/1.1")
+        if self.http2:
+            self.session = httpx.Client(
+                http2=True,
+                headers=self.headers,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        else:
+            self.session = requests.Session()
+            self.session.headers.update(self.headers)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+
+    def _send(self, path, payload, stream):
+        url = f"{self.base_url}{path}"
+        if self.http2:
+            request = self.session.build_request("POST", url, json=payload)
+            return self.session.send(request, stream=stream)
+        return self.session.post(url, json=payload, stream=stream,
+                                 timeout=(self.connect_timeout, self.read_timeout))
+
+    def add_header_listener(self, listener):
+        """Call listener with the headers of every API response, e.g. to follow x-ratelimit-* headers."""
+        self.header_listeners.append(listener)
+
+    def remove_header_listener(self, listener):
+        if listener in self.header_listeners:
+            self.header_listeners.remove(listener)
+
+    def add_first_token_listener(self, listener):
+        """Call listener(model, seconds) with the time to first token of every streamed reply, including abandoned ones."""
+        self.first_token_listeners.append(listener)
+
+    def report_first_token(self, model, seconds):
+        for listener in self.first_token_listeners:
+            listener(model, seconds)
+
+    def backoff_delay(self, attempt, response=None):
+        """Return how long to wait before the next attempt, preferring the server's Retry-After."""
+        if response is not None:
+            retry_after = get_retry_after(response)
+            if retry_after is not None:
+                return min(retry_after, self.backoff_cap)
+        # Full jitter keeps many clients from retrying in lockstep
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def post(self, path, payload, stream=False):
+        """POST a JSON payload, retrying connection errors and retryable statuses with jittered exponential backoff.
+
+        Streaming responses are only retried before the first byte of the body is read.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self._send(path, payload, stream)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logging.warning(f"OpenAI request failed ({e}); retrying in {delay:.2f}s")
+            else:
+                self.last_used = time.monotonic()
+                for listener in self.header_listeners:
+                    listener(response.headers)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+                delay = self.backoff_delay(attempt, response)
+                logging.warning(f"OpenAI request returned {response.status_code}; retrying in {delay:.2f}s")
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def warm_up(self):
+        """Open a pooled connection ahead of the next request so it skips the TCP and TLS handshake."""
+        try:
+            response = self.session.head(f"{self.base_url}/models", timeout=self.connect_timeout)
+            response.close()
+            self.last_used = time.monotonic()
+        except Exception as e:
+            logging.debug(f"Connection warm-up failed: {e}")
+
+    def warm_up_in_background(self):
+        """Warm the connection on a background thread unless it was used recently."""
+        if time.monotonic() - self.last_used < self.keepalive_seconds:
+            return
+        self.last_used = time.monotonic()
+        threading.Thread(target=self.warm_up, daemon=True).start()
+
+_client = None
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = OpenAIClient()
+    return _client
+
+def interact_with_model(model, messages, cache=None):
+    """Interact with the specified OpenAI GPT model, answering from the cache when possible."""
+    if cache is not None:
+        cached = cache.get_text(completion_key(model, messages))
+        if cached is not None:
+            return cached
     data = {
         "model": model,
         "messages": messages
     }
     try:
-        response = requests.post("https://api.openai.com/v1/chat/completions", json=data, headers=headers)
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
+        tracing.mark("request_sent")
+        response = get_client().post("/chat/completions", data)
+        content = response.json()['choices'][0]['message']['content']
+        tracing.mark("completion_done")
+        if cache is not None and content:
+            cache.put_text(completion_key(model, messages), content)
+        return content
     except Exception as e:
         logging.error(f"Error in interact_with_model: {e}")
         return None
+
+def parse_stream_line(line):
+    """Parse one server-sent event line, returning the text delta, None to skip, or False at the end of the stream."""
+    if not line or not line.startswith("data:"):
+        return None
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return False
+    choices = json.loads(payload).get("choices") or []
+    if not choices:
+        return None
+    return choices[0].get("delta", {}).get("content") or None
+
+def iter_response_lines(response):
+    """Iterate over the decoded lines of a streaming response from either HTTP backend."""
+    if httpx is not None and isinstance(response, httpx.Response):
+        return response.iter_lines()
+    return response.iter_lines(decode_unicode=True)
+
+async def stream_model_response(model, messages, cache=None):
+    """Stream the reply of the specified OpenAI GPT model, yielding text deltas as they arrive.
+
+    If a cache is given, the reply is stored in it once the stream completes. Lookups
+    are left to the caller, so that a hit can skip streaming altogether. A request
+    that fails before the first token yields nothing; a reply that breaks off
+    partway raises StreamInterrupted after its last delta.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    # The reader thread does not inherit the context, so hand it the turn's trace explicitly
+    trace = tracing.current_trace()
+    data = {
+        "model": model,
+        "messages": messages,
+        "stream": True
+    }
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop has already been closed
+            cancelled.set()
+
+    def read_stream():
+        response = None
+        parts = []
+        try:
+            tracing.mark("request_sent", trace)
+            tracing.add("request_bytes", len(json.dumps(data)), trace)
+            start = time.perf_counter()
+            response = get_client().post("/chat/completions", data, stream=True)
+            tracing.mark("first_byte", trace)
+            first_token_seen = False
+            for line in iter_response_lines(response):
+                delta = parse_stream_line(line)
+                if delta and not first_token_seen:
+                    first_token_seen = True
+                    get_client().report_first_token(model, time.perf_counter() - start)
+                if cancelled.is_set():
+                    # An abandoned reply, e.g. a hedge that lost, is read up to its first token so latency samples are not biased fast
+                    if first_token_seen or delta is False:
+                        break
+                    continue
+                if delta is False:
+                    tracing.mark("completion_done", trace)
+                    # Only a reply that reached the end of the stream is worth caching
+                    if cache is not None and parts:
+                        cache.put_text(completion_key(model, messages), "".join(parts))
+                    break
+                if delta:
+                    if not parts:
+                        tracing.mark("first_token", trace)
+                    parts.append(delta)
+                    tracing.add("completion_chunks", 1, trace)
+                    tracing.add("response_bytes", len(delta.encode("utf-8")), trace)
+                    put(delta)
+        except Exception as e:
+            logging.error(f"Error in stream_model_response: {e}")
+            if parts:
+                # The consumer has already seen part of the reply, so it must learn that the rest is missing
+                put(StreamInterrupted(str(e)))
+        finally:
+            if response is not None:
+                response.close()
+            put(None)
+
+    # The blocking HTTP read runs on its own thread and hands deltas back to the event loop
+    threading.Thread(target=read_stream, daemon=True).start()
+    try:
+        while True:
+            delta = await queue.get()
+            if delta is None:
+                return
+            if isinstance(delta, StreamInterrupted):
+                raise delta
+            yield delta
+    finally:
+        cancelled.set()
@@ -0,0 +1,160 @@
+import asyncio
+import mmap
+import os
+import sys
+from api_interaction import interact_with_model, get_client
+from batch import RateLimiter, REPLY_TOKEN_ESTIMATE
+from context_manager import get_token_counter, MESSAGE_OVERHEAD
+
+DEFAULT_CHUNK_TOKENS = 4000
+# Bytes of a line read per token of chunk; text averages about four bytes per token
+LINE_WINDOW_BYTES_PER_TOKEN = 4
+DEFAULT_INSTRUCTION = "Summarize the key points of this content."
+MAP_PROMPT = ("You are reading part {index} of a large file named {name}. {instruction} "
+              "Only use what is in this part; the answers for all parts are combined afterwards.")
+REDUCE_PROMPT = ("Below are answers written separately for consecutive parts of a large file named {name}, "
+                 "in order. Combine them into one answer to this instruction: {instruction}")
+
+def iter_text_chunks(path, max_tokens, count_tokens):
+    """Yield (text, end offset) chunks of a file of at most max_tokens tokens, split at line boundaries.
+
+    The file is memory-mapped and scanned a line at a time, looking for the end of
+    a line only within a window of about a chunk, so memory use is bounded by the
+    chunk size rather than the file size. Lines longer than a chunk are cut.
+    """
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            window = max(1, max_tokens * LINE_WINDOW_BYTES_PER_TOKEN)
+            lines = []
+            tokens = 0
+            position = 0
+            while position < size:
+                newline = mapped.find(b"\n", position, position + window)
+                if newline != -1:
+                    end = newline + 1
+                else:
+                    # e.g. minified JSON on a single line; cut it, but not inside a UTF-8 character
+                    end = min(position + window, size)
+                    while position + 1 < end < size and mapped[end] & 0xC0 == 0x80:
+                        end -= 1
+                text = mapped[position:end].decode("utf-8", errors="replace")
+                line_tokens = count_tokens(text)
+                if lines and tokens + line_tokens > max_tokens:
+                    yield "".join(lines), position
+                    lines = []
+                    tokens = 0
+                if line_tokens > max_tokens:
+                    step = max(1, len(text) * max_tokens // line_tokens)
+                    for start in range(0, len(text), step):
+                        yield text[start:start + step], end
+                else:
+                    lines.append(text)
+                    tokens += line_tokens
+                position = end
+            if lines:
+                yield "".join(lines), size
+
+def group_by_tokens(texts, max_tokens, count_tokens):
+    """Split texts into consecutive groups within max_tokens, with at least two texts per group."""
+    groups = [[]]
+    tokens = 0
+    for text in texts:
+        text_tokens = count_tokens(text)
+        if len(groups[-1]) >= 2 and tokens + text_tokens > max_tokens:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(text)
+        tokens += text_tokens
+    return groups
+
+class Progress:
+    """Prints how far the map and reduce stages have got on one status line."""
+
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+        self.read_bytes = 0
+        self.chunks = 0
+        self.mapped = 0
+        self.reduce_pass = 0
+
+    def show(self):
+        read = 100 * self.read_bytes // self.total_bytes if self.total_bytes else 100
+        status = f"\rRead {read}% | {self.mapped}/{self.chunks} parts answered"
+        if self.reduce_pass:
+            status += f" | combining (pass {self.reduce_pass})"
+        print(status, end="", file=sys.stderr, flush=True)
+
+async def map_reduce_file(path, model, instruction=DEFAULT_INSTRUCTION, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                          concurrency=4, cache=None):
+    """Answer an instruction about a file of any size and return the answer, or None if every request failed.
+
+    The file is split into chunks that each fit a request. The chunks are
+    answered concurrently (map), and the answers are then combined a group at a
+    time until one is left (reduce). At most `concurrency` chunks are held in
+    memory or in flight at once.
+    """
+    count_tokens = get_token_counter(model)
+    name = os.path.basename(path)
+    limiter = RateLimiter()
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = None
+    answers = {}
+
+    async def ask(system_message, text):
+        messages = [{"role": "system", "content": system_message}, {"role": "user", "content": text}]
+        tokens = sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD for message in messages)
+        await limiter.acquire(tokens + REPLY_TOKEN_ESTIMATE)
+        return await asyncio.to_thread(interact_with_model, model, messages, cache)
+
+    async def answer_chunk(index, text):
+        try:
+            answers[index] = await ask(MAP_PROMPT.format(index=index, name=name, instruction=instruction), text)
+        finally:
+            semaphore.release()
+            progress.mapped += 1
+            progress.show()
+
+    async def combine(group):
+        if len(group) == 1:
+            return group[0]
+        async with semaphore:
+            return await ask(REDUCE_PROMPT.format(name=name, instruction=instruction),
+                             "\n\n".join(f"Part {index}:\n{text}" for index, text in enumerate(group, 1)))
+
+    chunks = iter_text_chunks(path, chunk_tokens, count_tokens)
+    try:
+        progress = Progress(os.path.getsize(path))
+        get_client().add_header_listener(limiter.update_from_headers)
+        tasks = set()
+        # Tokenizing runs off the event loop; the semaphore keeps the reader from running ahead of the requests
+        while True:
+            await semaphore.acquire()
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                semaphore.release()
+                break
+            text, progress.read_bytes = chunk
+            progress.chunks += 1
+            progress.show()
+            task = asyncio.create_task(answer_chunk(progress.chunks, text))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+        partials = [answers[index] for index in sorted(answers) if answers[index]]
+        failed = len(answers) - len(partials)
+        if failed:
+            print(f"\n{failed} of {len(answers)} parts could not be answered; see the log for details.", file=sys.stderr)
+        while len(partials) > 1:
+            progress.reduce_pass += 1
+            progress.show()
+            groups = group_by_tokens(partials, chunk_tokens, count_tokens)
+            partials = [partial for partial in await asyncio.gather(*(combine(group) for group in groups)) if partial]
+        return partials[0] if partials else None
+    finally:
+        chunks.close()
+        print(file=sys.stderr)
+        get_client().remove_header_listener(limiter.update_from_headers)
@@ -0,0 +1,240 @@
+import logging
+import queue
+import subprocess
+import threading
+import time
+import tracing
+
+class RingBuffer:
+    """A bounded byte ring buffer shared between one writer and one reader thread.
+
+    Reads always return whole frames of frame_bytes, so a sample split across two
+    network chunks is never handed to the device on its own.
+    """
+
+    def __init__(self, capacity, frame_bytes=1):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        self.frame_bytes = frame_bytes
+        self.start = 0
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        """Write data, blocking while the buffer is full."""
+        view = memoryview(data)
+        with self.condition:
+            while view:
+                while self.size == self.capacity and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                end = (self.start + self.size) % self.capacity
+                count = min(len(view), self.capacity - self.size, self.capacity - end)
+                self.buffer[end:end + count] = view[:count]
+                self.size += count
+                view = view[count:]
+                self.condition.notify_all()
+
+    def read(self, max_bytes, timeout=None):
+        """Read up to max_bytes, waiting up to timeout for a whole frame. Returns b"" if none is available."""
+        with self.condition:
+            # Less than a frame, e.g. after an odd-length PCM chunk, cannot be read yet, so keep waiting for more
+            self.condition.wait_for(lambda: self.size >= self.frame_bytes or self.closed, timeout)
+            count = min(max_bytes, self.size, self.capacity - self.start)
+            count -= count % self.frame_bytes
+            # Slicing a memoryview does not copy, so the bytes object is the only copy made
+            data = bytes(memoryview(self.buffer)[self.start:self.start + count])
+            self.start = (self.start + count) % self.capacity
+            self.size -= count
+            self.condition.notify_all()
+            return data
+
+    def close(self):
+        """Mark the end of the data; readers drain what is left and writers stop blocking."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    @property
+    def drained(self):
+        return self.closed and self.size < self.frame_bytes
+
+class Mp3Decoder:
+    """Incrementally decode MP3 data to raw PCM with a long-running ffmpeg process."""
+
+    def __init__(self, output, sample_rate, channels, trace=None):
+        self.output = output
+        self.trace = trace
+        # Imported here so text-only sessions never load the audio libraries
+        from pydub import AudioSegment
+        self.process = subprocess.Popen(
+            [AudioSegment.converter, "-loglevel", "error", "-f", "mp3", "-i", "pipe:0",
+             "-f", "s16le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.reader = threading.Thread(target=self._read_output, daemon=True)
+        self.reader.start()
+
+    def _read_output(self):
+        try:
+            while chunk := self.process.stdout.read1(8192):
+                self.output.write(chunk)
+            self.process.wait()
+            tracing.mark("decode_done", self.trace)
+        except Exception as e:
+            logging.error(f"Error reading decoded audio: {e}")
+        finally:
+            self.output.close()
+
+    def feed(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def close(self):
+        """Close the input; the decoder drains into the output and closes it on its own."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+class PlaybackJob:
+    """One response queued for playback; audio is fed in as it arrives from the network.
+
+    MP3 input goes through an incremental ffmpeg decoder. Raw 16-bit PCM input is
+    written straight into the ring buffer with no subprocess and no extra decoding.
+    """
+
+    def __init__(self, player, audio_format="mp3", sample_rate=None):
+        self.sample_rate = sample_rate or player.sample_rate
+        # Playback happens on the worker thread, outside the turn's context
+        self.trace = tracing.current_trace()
+        self.ring = RingBuffer(player.buffer_seconds * self.sample_rate * player.frame_bytes, player.frame_bytes)
+        self.decoder = None
+        if audio_format == "mp3":
+            self.decoder = Mp3Decoder(self.ring, self.sample_rate, player.channels, self.trace)
+        self.first_feed_time = None
+
+    def feed(self, data):
+        """Feed encoded audio; blocks while the playback buffer is full."""
+        if self.first_feed_time is None:
+            self.first_feed_time = time.perf_counter()
+        if self.decoder is None:
+            self.ring.write(data)
+        else:
+            self.decoder.feed(data)
+
+    def finish(self):
+        """Signal that no more audio will be fed."""
+        if self.decoder is None:
+            self.ring.close()
+            tracing.mark("decode_done", self.trace)
+        else:
+            self.decoder.close()
+
+class AudioPlayer:
+    """A persistent playback engine with one output stream and a single worker playing jobs in order."""
+
+    def __init__(self, sample_rate=44100, channels=1, buffer_seconds=10, period_frames=2048):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_bytes = 2 * channels
+        self.buffer_seconds = buffer_seconds
+        self.period_bytes = period_frames * self.frame_bytes
+        self.jobs = queue.Queue()
+        self.underruns = 0
+        self.jobs_played = 0
+        self.latencies = []
+        import pyaudio
+        self.pyaudio_module = pyaudio
+        self.pyaudio = pyaudio.PyAudio()
+        self.stream = None
+        self.stream_rate = None
+        self._open_stream(sample_rate)
+        self.worker = threading.Thread(target=self._play_jobs, daemon=True)
+        self.worker.start()
+
+    def _open_stream(self, sample_rate):
+        """Open the output stream at the given rate, replacing the current one only if the rate differs."""
+        if self.stream_rate == sample_rate:
+            return
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+        self.stream = self.pyaudio.open(format=self.pyaudio_module.paInt16, channels=self.channels, rate=sample_rate, output=True)
+        self.stream_rate = sample_rate
+
+    def begin(self, audio_format="mp3", sample_rate=None):
+        """Queue a new playback job and return it so audio can be fed as it arrives."""
+        job = PlaybackJob(self, audio_format, sample_rate)
+        self.jobs.put(job)
+        return job
+
+    def _play_jobs(self):
+        while (job := self.jobs.get()) is not None:
+            try:
+                self._play(job)
+            except Exception as e:
+                logging.error(f"Error while playing audio: {e}")
+                job.ring.close()
+
+    def _play(self, job):
+        self._open_stream(job.sample_rate)
+        started = False
+        starved = False
+        while not job.ring.drained:
+            data = job.ring.read(self.period_bytes, timeout=0.05)
+            if not data:
+                if started and not starved and not job.ring.drained:
+                    self.underruns += 1
+                    starved = True
+                continue
+            starved = False
+            if not started:
+                started = True
+                tracing.mark("playback_start", job.trace)
+                self.jobs_played += 1
+                if job.first_feed_time is not None:
+                    self.latencies.append(time.perf_counter() - job.first_feed_time)
+            self.stream.write(data)
+
+    def stats(self):
+        """Return playback counters: jobs played, buffer underruns and feed-to-sound latency."""
+        return {
+            "jobs_played": self.jobs_played,
+            "underruns": self.underruns,
+            "last_latency": self.latencies[-1] if self.latencies else None,
+            "mean_latency": sum(self.latencies) / len(self.latencies) if self.latencies else None,
+        }
+
+    def close(self):
+        """Finish queued playback and release the audio device."""
+        self.jobs.put(None)
+        self.worker.join()
+        self.stream.stop_stream()
+        self.stream.close()
+        self.pyaudio.terminate()
+
+_player = None
+_player_lock = threading.Lock()
+
+def get_audio_player(sample_rate=None):
+    """Return the shared audio player, opening the output device on first use.
+
+    Pass the sample rate of the audio about to be played, so the stream opened
+    on first use does not have to be reopened at another rate for the first reply.
+    """
+    global _player
+    with _player_lock:
+        if _player is None:
+            _player = AudioPlayer(sample_rate) if sample_rate else AudioPlayer()
+        return _player
+
+def close_audio_player():
+    """Close the shared audio player if it was opened."""
+    global _player
+    with _player_lock:
+        if _player is not None:
+            _player.close()
+            logging.info(f"Audio playback stats: {_player.stats()}")
+            _player = None
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from api_interaction import interact_with_model, get_client
+from chat_management import save_audio_file
+from context_manager import get_token_counter, MESSAGE_OVERHEAD
+from voice_handler import TTSSession
+
+# Expected reply size used when reserving tokens for a request
+REPLY_TOKEN_ESTIMATE = 500
+DURATION_PART = re.compile(r"([\d.]+)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_reset_duration(value):
+    """Parse an x-ratelimit-reset-* value such as '1s', '6m0s' or '20ms' into seconds."""
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_PART.findall(value or ""))
+
+class TokenBucket:
+    """A token bucket refilled continuously at capacity per minute."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Return how long to wait until amount tokens are available (0 if they are available now)."""
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) * 60 / self.capacity
+
+    def sync(self, limit, remaining, reset_seconds):
+        """Adopt the server's view of the limit and of what is left of it."""
+        self.refill()
+        self.capacity = limit
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0 and reset_seconds:
+            # Nothing is left until the window resets
+            self.tokens = -reset_seconds * limit / 60
+
+class RateLimiter:
+    """Schedules requests within the request and token limits reported by the x-ratelimit-* headers.
+
+    Starts from conservative defaults and adapts to the limits the server
+    reports with each response. Headers arrive on the request threads while
+    requests are scheduled on the event loop, so the buckets have a thread
+    lock of their own.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=30000):
+        self.buckets = {"requests": TokenBucket(requests_per_minute), "tokens": TokenBucket(tokens_per_minute)}
+        self.lock = asyncio.Lock()
+        self.buckets_lock = threading.Lock()
+
+    def update_from_headers(self, headers):
+        with self.buckets_lock:
+            for name, bucket in self.buckets.items():
+                limit = headers.get(f"x-ratelimit-limit-{name}")
+                remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                if limit is None or remaining is None:
+                    continue
+                try:
+                    bucket.sync(int(limit), int(remaining), parse_reset_duration(headers.get(f"x-ratelimit-reset-{name}")))
+                except ValueError:
+                    logging.debug(f"Ignoring malformed rate limit headers for {name}")
+
+    def reserve(self, tokens):
+        """Reserve one request of this many tokens if it fits now, else return how long to wait."""
+        with self.buckets_lock:
+            delay = max(self.buckets["requests"].wait_time(1), self.buckets["tokens"].wait_time(tokens))
+            if delay <= 0:
+                self.buckets["requests"].tokens -= 1
+                self.buckets["tokens"].tokens -= tokens
+            return delay
+
+    async def acquire(self, tokens):
+        """Wait until one request using about this many tokens fits within both limits, then reserve it."""
+        async with self.lock:
+            while (delay := self.reserve(tokens)) > 0:
+                await asyncio.sleep(delay)
+
+def read_jobs(input_path, system_message):
+    """Read prompts from a JSONL file ('-' for stdin).
+
+    Each line is either a JSON object with "prompt" or "messages" and an optional "id",
+    or a bare JSON string prompt. The system message is added unless the messages
+    already start with one.
+    """
+    file = sys.stdin if input_path == "-" else open(input_path, "r", encoding="utf-8")
+    try:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"prompt": item}
+            messages = item.get("messages") or [{"role": "user", "content": item["prompt"]}]
+            if messages[0]["role"] != "system":
+                messages = [{"role": "system", "content": system_message}] + messages
+            yield {"id": str(item.get("id", line_number)), "messages": messages}
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+def load_completed_ids(output_path):
+    """Return the IDs already answered successfully in an earlier run writing to the same output."""
+    completed = set()
+    try:
+        with open(output_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash; that job is simply run again
+                    continue
+                if result.get("response") is not None:
+                    completed.add(result["id"])
+    except FileNotFoundError:
+        pass
+    return completed
+
+class ResultWriter:
+    """Appends results to the output as JSONL, in completion order or, if ordered, in input order."""
+
+    def __init__(self, file, ordered):
+        self.file = file
+        self.ordered = ordered
+        self.waiting = {}
+        self.next_index = 0
+
+    def write(self, index, result):
+        if not self.ordered:
+            self._write(result)
+            return
+        self.waiting[index] = result
+        while self.next_index in self.waiting:
+            self._write(self.waiting.pop(self.next_index))
+            self.next_index += 1
+
+    def _write(self, result):
+        self.file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+async def run_batch(input_path, output_path, model, system_message, voice_config=None,
+                    concurrency=4, ordered=False, cache=None):
+    """Answer every prompt of a JSONL input with bounded concurrency, appending results to output_path.
+
+    Prompts already answered in output_path are skipped, so an interrupted run can be restarted
+    with the same arguments. With a voice, each answer is also synthesized and saved as audio.
+    """
+    completed = load_completed_ids(output_path)
+    jobs = [job for job in read_jobs(input_path, system_message) if job["id"] not in completed]
+    total = len(jobs)
+    print(f"{len(completed)} prompts already answered, {total} to go.", file=sys.stderr)
+    if not jobs:
+        return
+
+    count_tokens = get_token_counter(model)
+    limiter = RateLimiter()
+    semaphore = asyncio.Semaphore(concurrency)
+    tts_session = TTSSession(voice_config) if voice_config else None
+    finished = 0
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        writer = ResultWriter(output, ordered)
+
+        async def run(index, job):
+            nonlocal finished
+            async with semaphore:
+                tokens = sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD for message in job["messages"])
+                await limiter.acquire(tokens + REPLY_TOKEN_ESTIMATE)
+                start = time.perf_counter()
+                response = await asyncio.to_thread(interact_with_model, model, job["messages"], cache)
+                result = {"id": job["id"], "model": model, "response": response,
+                          "latency": round(time.perf_counter() - start, 3)}
+            if response is None:
+                result["error"] = "request failed; see the log for details"
+            elif tts_session:
+                audio_sink = await tts_session.synthesize_text(response, play=False)
+                if audio_sink is not None:
+                    result["audio_path"] = await asyncio.to_thread(
+                        save_audio_file, audio_sink, f"{job['id']}_{response}")
+            writer.write(index, result)
+            finished += 1
+            print(f"\rCompleted {finished}/{total}", end="", file=sys.stderr, flush=True)
+
+        get_client().add_header_listener(limiter.update_from_headers)
+        try:
+            await asyncio.gather(*(run(index, job) for index, job in enumerate(jobs)))
+        finally:
+            print(file=sys.stderr)
+            get_client().remove_header_listener(limiter.update_from_headers)
+            if tts_session:
+                await tts_session.close()
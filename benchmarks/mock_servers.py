@@ -0,0 +1,150 @@
+"""Local stand-ins for the OpenAI chat completions API and the ElevenLabs TTS websocket.
+
+Both servers answer with scripted content and latency so cmdGPT's own overhead can be
+measured without network noise or API costs. Point cmdGPT at them with
+OPENAI_BASE_URL=http://127.0.0.1:<openai port>/v1 and ELEVENLABS_BASE_URL=http://127.0.0.1:<tts port>.
+
+Run standalone with: python benchmarks/mock_servers.py --help
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import struct
+import time
+import websockets
+
+DEFAULT_REPLY = ("Sure. Here is a short answer that spans a few sentences. It is long enough to exercise "
+                 "sentence chunking in the voice pipeline. That is all there is to it.")
+
+class MockSettings:
+    """Scripted behavior of the mock servers."""
+
+    def __init__(self, reply=DEFAULT_REPLY, first_token_delay=0.2, token_delay=0.01, chars_per_token=4,
+                 tts_first_audio_delay=0.15, audio_chunk_bytes=4800, audio_seconds_per_char=0.06,
+                 audio_chunk_delay=0.005, sample_rate=24000):
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.chars_per_token = chars_per_token
+        self.tts_first_audio_delay = tts_first_audio_delay
+        self.audio_chunk_bytes = audio_chunk_bytes
+        self.audio_seconds_per_char = audio_seconds_per_char
+        self.audio_chunk_delay = audio_chunk_delay
+        self.sample_rate = sample_rate
+
+def reply_tokens(settings):
+    reply = settings.reply
+    return [reply[i:i + settings.chars_per_token] for i in range(0, len(reply), settings.chars_per_token)]
+
+async def read_http_request(reader):
+    """Read one HTTP/1.1 request, returning (method, path, headers, body) or None when the connection closes."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+RATE_LIMIT_HEADERS = (
+    "x-ratelimit-limit-requests: 10000\r\nx-ratelimit-remaining-requests: 9999\r\nx-ratelimit-reset-requests: 6ms\r\n"
+    "x-ratelimit-limit-tokens: 2000000\r\nx-ratelimit-remaining-tokens: 1999000\r\nx-ratelimit-reset-tokens: 30ms\r\n"
+)
+
+async def handle_openai(reader, writer, settings):
+    """Serve keep-alive HTTP connections speaking just enough of the chat completions API."""
+    try:
+        while (request := await read_http_request(reader)) is not None:
+            method, path, _, body = request
+            if method == "HEAD" or not path.endswith("/chat/completions"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+                continue
+            payload = json.loads(body)
+            await asyncio.sleep(settings.first_token_delay)
+            if not payload.get("stream"):
+                content = json.dumps({"choices": [{"message": {"role": "assistant", "content": settings.reply}}]}).encode()
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n{RATE_LIMIT_HEADERS}"
+                             f"Content-Length: {len(content)}\r\n\r\n".encode() + content)
+                await writer.drain()
+                continue
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n{RATE_LIMIT_HEADERS}"
+                         "Transfer-Encoding: chunked\r\n\r\n".encode())
+            for index, token in enumerate(reply_tokens(settings)):
+                if index:
+                    await asyncio.sleep(settings.token_delay)
+                event = f"data: {json.dumps({'choices': [{'delta': {'content': token}}]})}\n\n".encode()
+                writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                await writer.drain()
+            done = b"data: [DONE]\n\n"
+            writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+def tone(sample_rate, seconds, frequency=440):
+    """Return 16-bit mono PCM of a quiet sine tone."""
+    count = int(sample_rate * seconds)
+    return struct.pack(f"<{count}h", *(int(2000 * math.sin(2 * math.pi * frequency * i / sample_rate)) for i in range(count)))
+
+async def handle_tts(websocket, settings):
+    """Speak just enough of the multi-context stream-input protocol: each text chunk is voiced as it
+    arrives, and close_context ends the context with an isFinal message."""
+    try:
+        async for message in websocket:
+            data = json.loads(message)
+            if data.get("close_socket"):
+                break
+            context_id = data.get("context_id", "default")
+            text = data.get("text", "")
+            if text.strip():
+                await asyncio.sleep(settings.tts_first_audio_delay)
+                audio = tone(settings.sample_rate, len(text) * settings.audio_seconds_per_char)
+                for start in range(0, len(audio), settings.audio_chunk_bytes):
+                    chunk = base64.b64encode(audio[start:start + settings.audio_chunk_bytes]).decode()
+                    await websocket.send(json.dumps({"audio": chunk, "contextId": context_id}))
+                    await asyncio.sleep(settings.audio_chunk_delay)
+            if data.get("close_context"):
+                await websocket.send(json.dumps({"isFinal": True, "contextId": context_id}))
+    except websockets.ConnectionClosed:
+        pass
+
+async def start_servers(settings, host="127.0.0.1", openai_port=0, tts_port=0):
+    """Start both mock servers and return them with the ports they listen on."""
+    openai_server = await asyncio.start_server(lambda r, w: handle_openai(r, w, settings), host, openai_port)
+    # The path argument is only passed by websockets releases before 10.1
+    tts_server = await websockets.serve(lambda websocket, path=None: handle_tts(websocket, settings), host, tts_port)
+    return openai_server, tts_server, openai_server.sockets[0].getsockname()[1], next(iter(tts_server.sockets)).getsockname()[1]
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run mock OpenAI and ElevenLabs servers for benchmarking")
+    parser.add_argument('--openai-port', type=int, default=0, help='Port of the mock OpenAI server (0 picks a free port)')
+    parser.add_argument('--tts-port', type=int, default=0, help='Port of the mock ElevenLabs websocket server')
+    parser.add_argument('--first-token-delay', type=float, default=0.2, help='Seconds before the first streamed token')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='Seconds between streamed tokens')
+    parser.add_argument('--reply-chars', type=int, default=None, help='Length of the scripted reply in characters')
+    parser.add_argument('--tts-first-audio-delay', type=float, default=0.15, help='Seconds before the audio of each text chunk starts')
+    parser.add_argument('--audio-chunk-bytes', type=int, default=4800, help='Size of each audio chunk')
+    args = parser.parse_args()
+
+    reply = DEFAULT_REPLY
+    if args.reply_chars:
+        reply = (DEFAULT_REPLY + " ") * (args.reply_chars // len(DEFAULT_REPLY) + 1)
+        reply = reply[:args.reply_chars]
+    settings = MockSettings(reply=reply, first_token_delay=args.first_token_delay, token_delay=args.token_delay,
+                            tts_first_audio_delay=args.tts_first_audio_delay, audio_chunk_bytes=args.audio_chunk_bytes)
+    openai_server, tts_server, openai_port, tts_port = await start_servers(settings, openai_port=args.openai_port,
+                                                                          tts_port=args.tts_port)
+    # The benchmark harness waits for this line to learn the ports
+    print(json.dumps({"openai_port": openai_port, "tts_port": tts_port, "started": time.time()}), flush=True)
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,221 @@
+"""Measure cmdGPT's own per-turn overhead against the local mock servers.
+
+Reports time-to-first-token, time-to-first-audio, end-to-end turn latency, transcript
+write cost and peak RSS over a run of turns, plus how turn latency and request size
+behave over a long session. Results are written as JSON so runs of different
+releases can be compared.
+
+Usage: python benchmarks/run_benchmarks.py [--turns 20] [--long-session-turns 200] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_VOICE = {"name": "Benchmark", "voice_id": "benchmark-voice", "output_format": "pcm_24000",
+                   "voice_settings": {"stability": 0.5, "similarity_boost": True}}
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process, or None where it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def summarize(samples):
+    """Return summary statistics of a list of seconds (or counts)."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "min": ordered[0],
+        "max": ordered[-1],
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start_mock_servers(args):
+    """Start the mock servers in a separate process so they do not count towards our RSS or CPU."""
+    command = [sys.executable, os.path.join(REPO_ROOT, "benchmarks", "mock_servers.py"),
+               "--first-token-delay", str(args.first_token_delay), "--token-delay", str(args.token_delay),
+               "--tts-first-audio-delay", str(args.tts_first_audio_delay)]
+    if args.reply_chars:
+        command += ["--reply-chars", str(args.reply_chars)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    ports = json.loads(process.stdout.readline())
+    return process, ports
+
+async def run_turn(model, context, tts_session, modules):
+    """Run one chat turn the way chat() does and return its timings."""
+    api_interaction, voice_handler = modules
+    timings = {}
+    request_messages = context.request_messages()
+    timings["request_bytes"] = len(json.dumps(request_messages))
+    text_queue = asyncio.Queue()
+
+    async def queued_text():
+        while (delta := await text_queue.get()) is not None:
+            yield delta
+
+    start = time.perf_counter()
+    tts_task = None
+    if tts_session:
+        tts_task = asyncio.create_task(
+            tts_session.synthesize(voice_handler.chunk_text_by_sentence(queued_text()), play=False))
+    parts = []
+    async for delta in api_interaction.stream_model_response(model, request_messages):
+        if not parts:
+            timings["ttft"] = time.perf_counter() - start
+        parts.append(delta)
+        text_queue.put_nowait(delta)
+    text_queue.put_nowait(None)
+    timings["completion"] = time.perf_counter() - start
+    if tts_task:
+        await tts_task
+        if tts_session.first_audio_time is not None:
+            timings["ttfa"] = tts_session.first_audio_time - start
+    timings["turn"] = time.perf_counter() - start
+    context.add({"role": "assistant", "content": "".join(parts)})
+    return timings
+
+async def run_benchmarks(args, ports):
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{ports['openai_port']}/v1"
+    os.environ["ELEVENLABS_BASE_URL"] = f"http://127.0.0.1:{ports['tts_port']}"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("ELEVENLABS_API_KEY", "benchmark")
+    sys.path.insert(0, REPO_ROOT)
+    import api_interaction
+    import voice_handler
+    from chat_management import save_chat_transcript
+    from context_manager import ConversationContext
+    from session_store import SessionStore, new_session_id
+    modules = (api_interaction, voice_handler)
+
+    model = "gpt-4o-2024-05-13"
+    store = SessionStore()
+    tts_session = None if args.no_voice else voice_handler.TTSSession(BENCHMARK_VOICE)
+    results = {"ttft": [], "ttfa": [], "completion": [], "turn": [], "transcript_write": []}
+
+    # Warm up imports, the connection pool and the TTS socket so the measured turns are steady state
+    warm_context = ConversationContext(model, "You are a benchmark.")
+    warm_context.add({"role": "user", "content": "warm up"})
+    await run_turn(model, warm_context, tts_session, modules)
+
+    context = ConversationContext(model, "You are a benchmark.")
+    session_id = new_session_id()
+    store.start_session(session_id, model, BENCHMARK_VOICE["name"])
+    transcript_path = os.path.join("chat_transcripts", f"chat_{session_id}.txt")
+    last_saved_index = 0
+    for turn in range(args.turns):
+        context.add({"role": "user", "content": f"Question number {turn}?"})
+        timings = await run_turn(model, context, tts_session, modules)
+        start = time.perf_counter()
+        save_chat_transcript(context.messages, last_saved_index, transcript_path)
+        store.append_messages(session_id, context.messages, last_saved_index, model, BENCHMARK_VOICE["name"])
+        timings["transcript_write"] = time.perf_counter() - start
+        last_saved_index = len(context.messages)
+        for name in results:
+            if name in timings:
+                results[name].append(timings[name])
+
+    # A long text-only session shows whether latency and request size stay flat as history grows
+    long_context = ConversationContext(model, "You are a benchmark.", budget=args.long_session_budget)
+    long_turns = []
+    for turn in range(args.long_session_turns):
+        long_context.add({"role": "user", "content": f"Long session question {turn}?"})
+        long_turns.append(await run_turn(model, long_context, None, modules))
+    decile = max(1, len(long_turns) // 10)
+
+    if tts_session:
+        await tts_session.close()
+    store.close()
+
+    metrics = {name: summarize(samples) for name, samples in results.items()}
+    if long_turns:
+        metrics["long_session"] = {
+            "turns": len(long_turns),
+            "first_decile_turn": summarize([t["turn"] for t in long_turns[:decile]]),
+            "last_decile_turn": summarize([t["turn"] for t in long_turns[-decile:]]),
+            "first_decile_request_bytes": summarize([t["request_bytes"] for t in long_turns[:decile]]),
+            "last_decile_request_bytes": summarize([t["request_bytes"] for t in long_turns[-decile:]]),
+        }
+    metrics["peak_rss_bytes"] = peak_rss_bytes()
+    return metrics
+
+def print_summary(metrics):
+    for name in ("ttft", "ttfa", "completion", "turn", "transcript_write"):
+        stats = metrics.get(name)
+        if stats:
+            print(f"{name:>17}: p50 {stats['p50'] * 1000:8.2f} ms | p95 {stats['p95'] * 1000:8.2f} ms | n={stats['n']}")
+    long_session = metrics.get("long_session")
+    if long_session:
+        print(f"     long session: turn p50 {long_session['first_decile_turn']['p50'] * 1000:.2f} ms -> "
+              f"{long_session['last_decile_turn']['p50'] * 1000:.2f} ms, request "
+              f"{long_session['first_decile_request_bytes']['p50']} -> {long_session['last_decile_request_bytes']['p50']} bytes")
+    if metrics.get("peak_rss_bytes"):
+        print(f"    peak RSS: {metrics['peak_rss_bytes'] / 1024 / 1024:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cmdGPT against local mock servers")
+    parser.add_argument('--turns', type=int, default=20, help='Measured turns with voice')
+    parser.add_argument('--long-session-turns', type=int, default=200, help='Turns in the long text-only session')
+    parser.add_argument('--long-session-budget', type=int, default=2000, help='Context budget of the long session in tokens')
+    parser.add_argument('--no-voice', action='store_true', help='Skip the TTS pipeline')
+    parser.add_argument('--first-token-delay', type=float, default=0.05, help='Mock server delay before the first token')
+    parser.add_argument('--token-delay', type=float, default=0.001, help='Mock server delay between tokens')
+    parser.add_argument('--tts-first-audio-delay', type=float, default=0.05, help='Mock TTS delay before audio')
+    parser.add_argument('--reply-chars', type=int, default=None, help='Length of the scripted reply')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    process, ports = start_mock_servers(args)
+    # Transcripts and the session database go to a scratch directory
+    workdir = tempfile.mkdtemp(prefix="cmdgpt-bench-")
+    os.chdir(workdir)
+    try:
+        metrics = asyncio.run(run_benchmarks(args, ports))
+    finally:
+        process.terminate()
+        process.wait()
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "metrics": metrics,
+    }
+    print_summary(metrics)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
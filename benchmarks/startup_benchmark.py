@@ -0,0 +1,132 @@
+"""Measure cmdGPT's cold start: import time and time until the first prompt is shown.
+
+Every run starts a fresh interpreter. Import time comes from `python -X importtime`,
+which also shows the slowest modules. Time to first prompt is measured from
+launching cmdGPT.py until it asks for input. The target is well under a second.
+
+Usage: python benchmarks/startup_benchmark.py [--runs 10] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from run_benchmarks import REPO_ROOT, summarize, git_revision
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+PROMPT_MARKER = b"Enter your choice"
+TARGET_SECONDS = 1.0
+# A run that shows no prompt within this long counts as failed
+PROMPT_TIMEOUT_SECONDS = 30
+
+def benchmark_environment():
+    """Environment of the measured runs: fake keys and an unreachable voice API, so nothing waits on the network."""
+    env = dict(os.environ)
+    env.update({"OPENAI_API_KEY": "benchmark", "ELEVENLABS_API_KEY": "benchmark",
+                "ELEVENLABS_BASE_URL": "http://127.0.0.1:9", "PYTHONDONTWRITEBYTECODE": "1"})
+    return env
+
+def measure_imports(workdir):
+    """Import cmdGPT in a fresh interpreter and return (total seconds, {module imported by cmdGPT: seconds})."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import cmdGPT"], cwd=workdir,
+                            env=dict(benchmark_environment(), PYTHONPATH=REPO_ROOT), capture_output=True, text=True)
+    # Each import is reported after the imports it triggered, indented one level deeper than its parent
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        depth, name, cumulative = len(match.group(3)), match.group(4), int(match.group(2)) / 1e6
+        if depth == 3:
+            modules[name] = cumulative
+        elif depth == 1:
+            if name == "cmdGPT":
+                return cumulative, modules
+            modules = {}
+    return None, {}
+
+def measure_first_prompt(workdir, args):
+    """Launch cmdGPT.py and return the seconds until it prints its first input prompt, or None if it never does."""
+    command = [sys.executable, "-u", os.path.join(REPO_ROOT, "cmdGPT.py"), "--model", args.model, "--no-cache"]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workdir, env=benchmark_environment(), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # Killing the process ends the output, which unblocks a read that would otherwise wait forever
+    timer = threading.Timer(PROMPT_TIMEOUT_SECONDS, process.kill)
+    timer.start()
+    output = b""
+    try:
+        # Check for the prompt before reading again: once it is shown, cmdGPT waits on stdin and prints nothing more
+        while PROMPT_MARKER not in output and (chunk := process.stdout.read1(4096)):
+            output += chunk
+        if PROMPT_MARKER in output:
+            return time.perf_counter() - start
+        return None
+    finally:
+        timer.cancel()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cmdGPT's cold start")
+    parser.add_argument('--runs', type=int, default=10, help='Fresh interpreters to start per measurement')
+    parser.add_argument('--model', type=str, default="gpt-4o-2024-05-13", help='Model passed to cmdGPT so it skips that prompt')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    # Logs, transcripts and the session database go to a scratch directory with the repo's voice config
+    workdir = tempfile.mkdtemp(prefix="cmdgpt-startup-")
+    for name in ("config.json", "voiceexamples.html"):
+        if os.path.exists(os.path.join(REPO_ROOT, name)):
+            shutil.copy(os.path.join(REPO_ROOT, name), workdir)
+
+    import_totals, first_prompts, modules = [], [], {}
+    for _ in range(args.runs):
+        total, run_modules = measure_imports(workdir)
+        if total is not None:
+            import_totals.append(total)
+        for name, seconds in run_modules.items():
+            modules.setdefault(name, []).append(seconds)
+        first_prompt = measure_first_prompt(workdir, args)
+        if first_prompt is not None:
+            first_prompts.append(first_prompt)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    slowest = sorted(((name, summarize(samples)["p50"]) for name, samples in modules.items()),
+                     key=lambda item: item[1], reverse=True)[:15]
+    metrics = {
+        "import": summarize(import_totals),
+        "first_prompt": summarize(first_prompts),
+        "failed_runs": args.runs - len(first_prompts),
+        "slowest_imports": dict(slowest),
+    }
+    for name in ("import", "first_prompt"):
+        stats = metrics[name]
+        if stats:
+            print(f"{name:>13}: p50 {stats['p50'] * 1000:8.1f} ms | p95 {stats['p95'] * 1000:8.1f} ms | n={stats['n']}")
+    for name, seconds in slowest:
+        print(f"{name:>24}: {seconds * 1000:8.1f} ms")
+    if metrics["first_prompt"] and metrics["first_prompt"]["p95"] > TARGET_SECONDS:
+        print(f"First prompt p95 is above the {TARGET_SECONDS:.1f} s target")
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "metrics": metrics,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_DIRECTORY = "cache"
+
+def completion_key(model, messages):
+    """Content-address a completion request by model and normalized messages."""
+    normalized = [{"role": message["role"], "content": message["content"].strip()} for message in messages]
+    return "completion-" + hash_payload({"model": model, "messages": normalized})
+
+def audio_key(voice_config, output_format, text):
+    """Content-address a speech synthesis by voice, voice settings, output format and normalized text."""
+    return "audio-" + hash_payload({
+        "voice_id": voice_config["voice_id"],
+        "voice_settings": voice_config.get("voice_settings", {}),
+        "output_format": output_format,
+        "text": " ".join(text.split()),
+    })
+
+def hash_payload(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """A two-tier cache for completions and synthesized audio.
+
+    Entries live in a small in-memory LRU and in a bounded directory on disk.
+    The disk index is built once at startup; after that, lookups and evictions
+    never scan the directory. Entries older than ttl_seconds are treated as
+    misses and removed, and the least recently used files are evicted once
+    the directory exceeds max_disk_bytes.
+    """
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_memory_bytes=32 * 1024 * 1024,
+                 max_disk_bytes=512 * 1024 * 1024, ttl_seconds=7 * 24 * 3600, enabled=True):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        # key -> (size, created), ordered from least to most recently used
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.lock = threading.Lock()
+        if enabled:
+            self._load_index()
+
+    def _load_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, entry.name, stat.st_size, stat.st_mtime))
+        for _, key, size, created in sorted(entries):
+            self.disk[key] = (size, created)
+            self.disk_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the cached bytes for a key, or None on a miss."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            # Every memory entry is also on disk, where its creation time is kept for the TTL check
+            entry = self.disk.get(key)
+            if key in self.memory and entry is not None and time.time() - entry[1] <= self.ttl_seconds:
+                self.memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return self.memory[key]
+        entry = self._find_on_disk(key)
+        if entry is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as file:
+                value = file.read()
+            os.utime(self._path(key), (time.time(), entry[1]))
+        except OSError as e:
+            self._forget_unreadable(key, e)
+            return None
+        with self.lock:
+            self.hits["disk"] += 1
+            self._remember(key, value)
+        return value
+
+    def get_path(self, key):
+        """Return the path of a cached file for a key, or None on a miss.
+
+        Unlike get, the entry is not read into memory, so large values such as
+        audio can be streamed from disk.
+        """
+        if not self.enabled:
+            return None
+        entry = self._find_on_disk(key)
+        if entry is None:
+            return None
+        try:
+            os.utime(self._path(key), (time.time(), entry[1]))
+        except OSError as e:
+            self._forget_unreadable(key, e)
+            return None
+        with self.lock:
+            self.hits["disk"] += 1
+        return self._path(key)
+
+    def _find_on_disk(self, key):
+        """Return the disk index entry for a key and mark it recently used, or None (counted as a miss)."""
+        with self.lock:
+            entry = self.disk.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.time() - entry[1] > self.ttl_seconds:
+                self._remove_from_disk(key)
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+            return entry
+
+    def _forget_unreadable(self, key, error):
+        logging.warning(f"Cache entry {key} could not be read: {error}")
+        with self.lock:
+            entry = self.disk.pop(key, None)
+            if entry:
+                self.disk_bytes -= entry[0]
+            self.misses += 1
+
+    def put(self, key, value):
+        """Store bytes under a key in both tiers."""
+        if not self.enabled or not value:
+            return
+        temp_path = self._path(key) + f".{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(value)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f"Cache entry {key} could not be written: {e}")
+            return
+        with self.lock:
+            self._add_to_disk(key, len(value))
+            self._remember(key, value)
+
+    def put_file(self, key, path):
+        """Copy a file into the disk tier under a key without reading it into memory."""
+        if not self.enabled:
+            return
+        temp_path = self._path(key) + f".{threading.get_ident()}.tmp"
+        try:
+            size = os.path.getsize(path)
+            if not size:
+                return
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f"Cache entry {key} could not be written: {e}")
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key))
+            self._add_to_disk(key, size)
+
+    def _add_to_disk(self, key, size):
+        previous = self.disk.pop(key, None)
+        if previous:
+            self.disk_bytes -= previous[0]
+        self.disk[key] = (size, time.time())
+        self.disk_bytes += size
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+            self._remove_from_disk(next(iter(self.disk)))
+
+    def get_text(self, key):
+        value = self.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def put_text(self, key, text):
+        self.put(key, text.encode("utf-8"))
+
+    def _remember(self, key, value):
+        if len(value) > self.max_memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = value
+        self.memory_bytes += len(value)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _remove_from_disk(self, key):
+        size, _ = self.disk.pop(key)
+        self.disk_bytes -= size
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        """Return hit and miss counts and the current size of each tier."""
+        return {
+            "memory_hits": self.hits["memory"],
+            "disk_hits": self.hits["disk"],
+            "misses": self.misses,
+            "memory_bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes,
+            "disk_entries": len(self.disk),
+        }
+
+_cache = None
+
+def get_cache(enabled=True):
+    """Return the shared result cache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        _cache = ResultCache(enabled=enabled)
+    return _cache
@@ -1,7 +1,12 @@
 import os
+import subprocess
+import uuid
 from datetime import datetime
-from pydub import AudioSegment
 from utils import sanitize_for_filename
+from session_store import get_session_store
+from retention import get_retention_manager
+from recall import get_recall_index
+import tracing
 
 current_chat_filename = None
 
@@ -16,7 +21,7 @@ def save_chat_transcript(messages, last_saved_index=0, filename=None):
         current_chat_filename = datetime.now().strftime("chat_transcripts/chat_%Y%m%d%H%M%S.txt")
 
     try:
-        with open(current_chat_filename, 'a', encoding='utf-8') as file:
+        with open(filename or current_chat_filename, 'a', encoding='utf-8') as file:
             for message in messages[last_saved_index:]:
                 role = message["role"].capitalize()
                 content = message["content"]
@@ -24,48 +29,88 @@ def save_chat_transcript(messages, last_saved_index=0, filename=None):
     except Exception as e:
         print(f"An error occurred while saving the chat transcript: {e}")
 
-def manage_chat_transcript_files():
-    """Manages the storage of chat transcript files."""
-    transcript_files = [os.path.join("chat_transcripts", f) for f in os.listdir("chat_transcripts") if f.endswith('.txt')]
-    transcript_files.sort(key=os.path.getctime, reverse=True)
+class AudioSink:
+    """Writes the audio of one response to a temporary file as it arrives.
 
-    # Keep only the last 10 transcript files
-    for file in transcript_files[10:]:
-        os.remove(file)
+    Chunks go straight to disk instead of accumulating in memory, so memory use
+    does not grow with the length of a reply. The file only appears under its
+    final name once save_audio_file commits it.
+    """
 
-def save_audio_file(audio_buffer, filename):
-    if not os.path.exists('chat_transcripts'):
-        os.makedirs('chat_transcripts')
+    def __init__(self, output_format="mp3_44100_128", directory='chat_transcripts'):
+        os.makedirs(directory, exist_ok=True)
+        self.output_format = output_format
+        self.directory = directory
+        self.path = os.path.join(directory, f"{uuid.uuid4().hex}.part")
+        self.file = open(self.path, "xb")
+        self.size = 0
+        # Set when the audio should also go into the result cache once it is persisted
+        self.cache_key = None
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        """Flush the audio to disk; after this the file at .path is complete."""
+        if not self.file.closed:
+            self.file.close()
+
+    def discard(self):
+        """Close and remove the temporary file, if it is still there."""
+        self.finish()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
+def encode_pcm_file(pcm_path, mp3_path, sample_rate):
+    """Encode a file of raw 16-bit mono PCM to MP3 with ffmpeg, reading it from disk rather than memory."""
+    from pydub import AudioSegment
+    temp_path = f"{mp3_path}.part"
+    subprocess.run([AudioSegment.converter, "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(sample_rate),
+                    "-ac", "1", "-i", pcm_path, "-f", "mp3", temp_path], check=True)
+    os.replace(temp_path, mp3_path)
+
+def save_audio_file(audio_sink, filename):
+    """Moves the audio of a response into place as an MP3 file, encoding raw PCM first, and returns the file path."""
     sanitized_filename = sanitize_for_filename(filename)
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    audio_file_path = os.path.join('chat_transcripts', f"{sanitized_filename}_{timestamp}.mp3")
+    audio_file_path = os.path.join(audio_sink.directory, f"{sanitized_filename}_{timestamp}.mp3")
 
     try:
-        with open(audio_file_path, 'wb') as file:
-            file.write(audio_buffer.getvalue())
-    except OSError as e:
+        audio_sink.finish()
+        if audio_sink.output_format.startswith("pcm"):
+            sample_rate = int(audio_sink.output_format.split("_")[1])
+            encode_pcm_file(audio_sink.path, audio_file_path, sample_rate)
+        else:
+            os.replace(audio_sink.path, audio_file_path)
+        return audio_file_path
+    except (OSError, subprocess.CalledProcessError) as e:
         print(f"An error occurred while saving the audio file: {e}")
+        return None
     finally:
-        audio_buffer.close()
-
-def manage_audio_files():
-    """Manages the storage of audio files."""
-    audio_files = [os.path.join("chat_transcripts", f) for f in os.listdir("chat_transcripts") if f.endswith('.mp3')]
-    audio_files.sort(key=os.path.getctime, reverse=True)
-
-    # Keep only the last 10 audio files
-    for file in audio_files[10:]:
-        os.remove(file)
-
-def get_sorted_transcript_files():
-    """Returns a list of sorted transcript files."""
-    files = [os.path.join("chat_transcripts", f) for f in os.listdir("chat_transcripts")]
-    files = [f for f in files if os.path.isfile(f)]
-    return sorted(files, key=os.path.getctime)
-
-def manage_transcript_files():
-    """Manages the storage of all transcript files."""
-    files = get_sorted_transcript_files()
-    while len(files) > 10:
-        os.remove(files.pop(0))
\ No newline at end of file
+        audio_sink.discard()
+
+def persist_audio(audio_sink, response, session_id, seq, trace=None, cache=None):
+    """Save the audio of a response, record it on its message and schedule pruning of old audio files.
+
+    If a cache is given and the sink has a cache key, the audio is copied into the cache before it is moved into place.
+    """
+    if cache is not None and audio_sink.cache_key:
+        audio_sink.finish()
+        cache.put_file(audio_sink.cache_key, audio_sink.path)
+    audio_file_path = save_audio_file(audio_sink, response)
+    tracing.mark("audio_saved", trace)
+    if audio_file_path:
+        get_session_store().set_audio_path(session_id, seq, audio_file_path)
+        get_retention_manager().track(audio_file_path)
+
+def save_session(session_id, messages, last_saved_index, model, voice_config):
+    """Write new messages to the text transcript and the session store, and index them for recall."""
+    transcript_path = os.path.join("chat_transcripts", f"chat_{session_id}.txt")
+    save_chat_transcript(messages, last_saved_index, transcript_path)
+    get_retention_manager().track(transcript_path)
+    get_session_store().append_messages(session_id, messages, last_saved_index, model,
+                                        voice_config['name'] if voice_config else None)
+    get_recall_index().schedule_update()
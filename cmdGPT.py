@@ -1,160 +1,580 @@
 import os
 import argparse
 import asyncio
-import openai
+import logging
+import threading
+import base64
+import shlex
 from datetime import datetime
 from dotenv import load_dotenv
 from colorama import Fore, init
 
 from utils import (clear_screen, display_initial_title, display_short_title, 
-                   animate_processing, clear_processing_message, sanitize_for_filename, check_and_run_getvoices)
+                   animate_processing, clear_processing_message, check_and_run_getvoices)
 from logging_config import setup_logging
-from voice_handler import select_voice, load_custom_voices, stream_audio_websocket
-from chat_management import save_chat_transcript, save_audio_file, manage_audio_files
-from api_interaction import interact_with_model
+from voice_handler import (select_voice, load_custom_voices, TTSSession, chunk_text_by_sentence,
+                           parse_output_format, play_audio_file)
+from chat_management import save_session, persist_audio
+from api_interaction import stream_model_response, get_client, StreamInterrupted
+from audio_player import get_audio_player, close_audio_player
+from context_manager import ConversationContext, CONTEXT_POLICIES
+from cache import get_cache, completion_key, audio_key
+from session_store import get_session_store, new_session_id
+from retention import get_retention_manager
+from batch import run_batch
+from tracing import get_tracer
+import tracing
+from daemon import run_daemon, DaemonClient
+from attachments import map_reduce_file, DEFAULT_CHUNK_TOKENS, DEFAULT_INSTRUCTION
+from routing import ROUTING_MODES, RoutedStream, fan_out, format_side_by_side, get_latency_stats
+from recall import get_recall_index, RECALL_RESULTS
 
 # Initialize colorama and load environment variables, set up logging
 init(autoreset=True)
 load_dotenv()
 setup_logging()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # Define colors for different types of messages
 user_color = Fore.GREEN
 cmdGPT_color = Fore.WHITE
 system_color = Fore.LIGHTBLACK_EX
 
+DEFAULT_MODEL = "gpt-4o-2024-05-13"
+DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant who responds very accurately, VERY concisely, and intelligently. Respond with an element of reddit/4chan humor but keep it professional."
+
 def parse_args():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description="cmdGPT Chat Application")
     parser.add_argument('--model', type=str, default=None, help='Choose the model to use')
     parser.add_argument('--voice', type=int, default=None, help='Choose the voice option')
     parser.add_argument('--system', type=str, default=None, help='Specify a system message')
+    parser.add_argument('--context-policy', choices=list(CONTEXT_POLICIES), default='window',
+                        help='How to trim long chats to the model context budget: keep the newest turns (window) or also summarize dropped turns (summarize)')
+    parser.add_argument('--context-budget', type=int, default=None, help='Maximum prompt tokens sent per request')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the APIs instead of reusing cached replies and audio')
+    parser.add_argument('--resume', type=str, default=None, help='Resume a saved chat session by its ID')
+    parser.add_argument('--sessions', action='store_true', help='List recent chat sessions and exit')
+    parser.add_argument('--search', type=str, default=None, help='Search past chat sessions and exit')
+    parser.add_argument('--batch', type=str, default=None, help="Answer the prompts of a JSONL file ('-' for stdin) without prompting, then exit")
+    parser.add_argument('--output', type=str, default='batch_results.jsonl', help='Where batch mode appends its JSONL results')
+    parser.add_argument('--concurrency', type=int, default=4, help='How many batch requests (or daemon replies) run at once')
+    parser.add_argument('--ordered', action='store_true', help='Write batch results in input order instead of completion order')
+    parser.add_argument('--trace', type=str, default=None, help='Append per-turn stage timings to this JSONL file')
+    parser.add_argument('--metrics', type=str, default=None, help='Keep a Prometheus text-format metrics snapshot in this file')
+    parser.add_argument('--file', type=str, default=None, help='Answer --instruction about a file of any size, then exit')
+    parser.add_argument('--instruction', type=str, default=DEFAULT_INSTRUCTION, help='What to do with --file or /attach')
+    parser.add_argument('--chunk-tokens', type=int, default=DEFAULT_CHUNK_TOKENS, help='Tokens per part when a file is split up')
+    parser.add_argument('--daemon', action='store_true', help='Serve many chats from one process over a local socket')
+    parser.add_argument('--connect', action='store_true', help='Chat through a running daemon instead of in this process')
+    parser.add_argument('--stats', action='store_true', help='Print p50/p95 timings per turn stage at exit')
+    parser.add_argument('--route', choices=ROUTING_MODES, default='single',
+                        help='hedge: send a backup request when the first token is slow; race: ask all --models and keep the fastest; fanout: show all answers side by side')
+    parser.add_argument('--models', type=str, default=None,
+                        help='Comma-separated models (names or numbers from the model menu) to hedge to, race or fan out to after the main model')
+    parser.add_argument('--dedupe', action='store_true', help='Offer the earlier answer when a question was already asked in a past session')
     return parser.parse_args()
 
+AVAILABLE_MODELS = {
+    "1": "gpt-4o-2024-05-13",
+    "2": "gpt-4-turbo-2024-04-09",
+    "3": "gpt-4-0125-preview",
+    "4": "gpt-4-1106-preview",
+    "5": "gpt-4-vision-preview",
+    "6": "gpt-3.5-turbo-1106",
+    "7": "gpt-3.5-turbo"
+}
+
 def select_model():
     """Select the GPT model to use."""
     print("\nSelect a model:")
-    models = {
-        "1": "gpt-4o-2024-05-13",
-        "2": "gpt-4-turbo-2024-04-09",
-        "3": "gpt-4-0125-preview",
-        "4": "gpt-4-1106-preview",
-        "5": "gpt-4-vision-preview",
-        "6": "gpt-3.5-turbo-1106",
-        "7": "gpt-3.5-turbo"
-    }
-    for key, value in models.items():
+    for key, value in AVAILABLE_MODELS.items():
         print(f"{key}. {value}")
     choice = input("Enter your choice (default is 1): ")
-    return models.get(choice, "gpt-4o-2024-05-13")
+    return AVAILABLE_MODELS.get(choice, DEFAULT_MODEL)
+
+def select_input_mode():
+    """Ask for the input mode; returns True for multi-line, False for standard."""
+    print("\nSelect input mode:")
+    print("1. Standard (Single line input)")
+    print("2. Multi-line (Type 'end' on a new line to finish)")
+    choice = input("Enter your choice (default is 1): ")
+    return choice.strip() == "2"
+
+def read_user_input(multiline):
+    """Read the next message from the terminal."""
+    if not multiline:
+        # Standard single line input
+        return input(f"\n{user_color}You: ")
+    # Multi-line input with reset handling
+    print(f"\n{user_color}Enter your text (type 'end' on a new line to finish, or type 'reset' to restart):")
+    user_input_lines = []
+    while True:
+        line = input(f"{user_color}")
+        if line.lower() == "end":
+            return "\n".join(user_input_lines)
+        elif line.lower() == "reset":
+            return "reset"
+        user_input_lines.append(line)
+
+def parse_models(value, model):
+    """Return the main model followed by the extra models of --models, without duplicates."""
+    models = [model]
+    for name in (value or "").split(","):
+        name = AVAILABLE_MODELS.get(name.strip(), name.strip())
+        if name and name not in models:
+            models.append(name)
+    return models
+
+def print_sessions(sessions):
+    """Print a listing of recent sessions."""
+    if not sessions:
+        print(f"{system_color}No saved sessions.")
+    for session_id, started_at, model, voice, message_count, first_prompt in sessions:
+        started = datetime.fromtimestamp(started_at).strftime("%Y-%m-%d %H:%M")
+        preview = (first_prompt or "").replace("\n", " ")[:60]
+        print(f"{system_color}{session_id} | {started} | {model} | {voice or 'No Voice'} | {message_count} messages | {preview}")
+
+def print_search_results(results):
+    """Print session search matches."""
+    if not results:
+        print(f"{system_color}No matches.")
+    for session_id, seq, role, snippet, created_at in results:
+        created = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M")
+        print(f"{system_color}{session_id} #{seq} | {created} | {role.capitalize()}: {snippet.replace(chr(10), ' ')}")
+
+def print_recalled(results):
+    """Print earlier questions and their answers, best match first."""
+    if not results:
+        print(f"{system_color}Nothing similar in earlier sessions.")
+    for score, session_id, seq, question, answer, created_at in results:
+        created = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M")
+        print(f"{system_color}{session_id} #{seq} | {created} | similarity {score:.2f}")
+        print(f"{user_color}  You: {question.replace(chr(10), ' ')[:200]}")
+        print(f"{cmdGPT_color}  cmdGPT: {answer.replace(chr(10), ' ')[:400]}")
+
+def print_stats(summary):
+    """Print the p50/p95 time from the start of a turn to each stage."""
+    print(f"{system_color}\n{'Stage':<20}{'Turns':>6}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    for stage, (count, p50, p95) in summary.items():
+        print(f"{system_color}{stage:<20}{count:>6}{p50 * 1000:>12.1f}{p95 * 1000:>12.1f}")
+
+def print_history(messages):
+    """Print the user and assistant messages of a resumed session."""
+    for message in messages:
+        if message["role"] == "user":
+            print(f"\n{user_color}You: {message['content']}")
+        elif message["role"] == "assistant":
+            print(f"{cmdGPT_color}cmdGPT: {message['content']}")
+
+async def stream_and_print_response(model, messages, on_delta=None, cache=None, stream=None):
+    """Stream the model reply (or the given routed stream) to the terminal as it arrives and return the full text.
+
+    A reply that breaks off partway is reported and returned as "", so the turn is not saved.
+    """
+    processing_task = asyncio.create_task(animate_processing(f"{system_color}Processing OpenAI Chat"))
+    response_parts = []
+    interrupted = None
+    if stream is None:
+        stream = stream_model_response(model, messages, cache)
+    try:
+        async for delta in stream:
+            if not response_parts:
+                # Swap the processing animation for the reply on the first token
+                processing_task.cancel()
+                clear_processing_message()
+                winner = getattr(stream, "model", model)
+                label = f"cmdGPT ({winner})" if winner != model else "cmdGPT"
+                print(f"{cmdGPT_color}{label}: ", end="", flush=True)
+            response_parts.append(delta)
+            if on_delta:
+                on_delta(delta)
+            print(f"{cmdGPT_color}{delta}", end="", flush=True)
+    except StreamInterrupted as e:
+        interrupted = e
+    finally:
+        if response_parts:
+            print()
+        else:
+            processing_task.cancel()
+            clear_processing_message()
+    if interrupted is not None:
+        print(f"{system_color}The reply was cut off ({interrupted}) and will not be saved.")
+        return ""
+    return "".join(response_parts)
+
+async def stream_response_with_voice(model, messages, tts_session, cache=None, stream=None):
+    """Stream the model reply while speaking it sentence by sentence as it is generated."""
+    text_queue = asyncio.Queue()
+
+    async def queued_text():
+        while (delta := await text_queue.get()) is not None:
+            yield delta
+
+    tts_task = asyncio.create_task(tts_session.synthesize(chunk_text_by_sentence(queued_text())))
+    try:
+        response = await stream_and_print_response(model, messages, text_queue.put_nowait, cache, stream)
+    finally:
+        text_queue.put_nowait(None)
+    audio_sink = await tts_task
+    if not response and audio_sink is not None:
+        # Audio of a reply that is not kept is not kept either
+        audio_sink.discard()
+        audio_sink = None
+    return response, audio_sink
+
+async def speak_text(tts_session, text, cache):
+    """Speak a complete text, playing cached audio straight away if this voice already said it."""
+    key = audio_key(tts_session.voice_config, tts_session.output_format, text)
+    cached_path = cache.get_path(key)
+    if cached_path is not None:
+        return await play_audio_file(cached_path, tts_session.output_format)
+    audio_sink = await tts_session.synthesize_text(text)
+    if audio_sink is not None:
+        # Copied into the cache when the audio is persisted, off the event loop
+        audio_sink.cache_key = key
+    return audio_sink
+
+async def respond_fan_out(models, messages, tts_session, cache):
+    """Ask several models at once, show their answers side by side and keep the main model's answer."""
+    processing_task = asyncio.create_task(animate_processing(f"{system_color}Asking {len(models)} models"))
+    try:
+        answers = await fan_out(models, messages, cache)
+    finally:
+        processing_task.cancel()
+        clear_processing_message()
+    print(f"{cmdGPT_color}{format_side_by_side(answers)}")
+    response = answers[0][1]
+    audio_sink = await speak_text(tts_session, response, cache) if tts_session and response else None
+    return response, audio_sink
+
+async def respond(model, messages, tts_session, cache, models=None, route="single"):
+    """Answer a turn from the cache when possible, otherwise stream it from the model or route it across models."""
+    cached_response = cache.get_text(completion_key(model, messages))
+    if cached_response is not None and route != "fanout":
+        print(f"{cmdGPT_color}cmdGPT: {cached_response}")
+        audio_sink = await speak_text(tts_session, cached_response, cache) if tts_session else None
+        return cached_response, audio_sink
+
+    if route == "fanout":
+        return await respond_fan_out(models, messages, tts_session, cache)
+    stream = RoutedStream(models, messages, route, cache) if route in ("hedge", "race") else None
+    if not tts_session:
+        return await stream_and_print_response(model, messages, cache=cache, stream=stream), None
+    response, audio_sink = await stream_response_with_voice(model, messages, tts_session, cache, stream)
+    if response and audio_sink is not None:
+        audio_sink.cache_key = audio_key(tts_session.voice_config, tts_session.output_format, response)
+    return response, audio_sink
+
+async def recall_earlier_answers(command):
+    """Handle '/recall QUERY' by printing the most similar questions of earlier sessions."""
+    query = command[len("/recall"):].strip()
+    if not query:
+        print(f"{system_color}Usage: /recall QUERY")
+        return
+    print_recalled(await asyncio.to_thread(get_recall_index().search, query, RECALL_RESULTS))
+
+async def offer_recalled_answer(question):
+    """Offer the answer to a near-identical earlier question; return it if the user takes it, else None."""
+    duplicate = await asyncio.to_thread(get_recall_index().find_duplicate, question)
+    if duplicate is None:
+        return None
+    print(f"{system_color}This was asked before:")
+    print_recalled([duplicate])
+    if input(f"{system_color}Use that answer instead of asking the model? (y/n): ").strip().lower() != "y":
+        return None
+    return duplicate[4]
+
+async def attach_file(command, model, args, cache):
+    """Handle '/attach PATH [instruction]' and return (user message, answer), or None if there is no answer."""
+    try:
+        parts = shlex.split(command[len("/attach"):], posix=os.name != "nt")
+    except ValueError:
+        parts = []
+    if not parts:
+        print(f"{system_color}Usage: /attach PATH [instruction]")
+        return None
+    path = os.path.expanduser(parts[0].strip('"'))
+    instruction = " ".join(parts[1:]) or args.instruction
+    if not os.path.isfile(path):
+        print(f"{system_color}File not found: {path}")
+        return None
+    answer = await map_reduce_file(path, model, instruction, args.chunk_tokens, args.concurrency, cache)
+    if not answer:
+        print(f"{system_color}No answer; see the log for details.")
+        return None
+    print(f"{cmdGPT_color}cmdGPT: {answer}")
+    return f"[Attached {os.path.basename(path)}] {instruction}", answer
+
+async def print_remote_reply(client, user_input):
+    """Send a message to the daemon, printing the reply and playing its audio as they arrive."""
+    processing_task = asyncio.create_task(animate_processing(f"{system_color}Processing OpenAI Chat"))
+    started = False
+    playback_job = None
+    try:
+        async for event in client.send_message(user_input):
+            if event["type"] == "delta":
+                if not started:
+                    processing_task.cancel()
+                    clear_processing_message()
+                    print(f"{cmdGPT_color}cmdGPT: ", end="", flush=True)
+                    started = True
+                print(f"{cmdGPT_color}{event['text']}", end="", flush=True)
+            elif event["type"] == "audio":
+                if playback_job is None:
+                    codec, sample_rate = parse_output_format(event["format"])
+                    playback_job = get_audio_player(sample_rate).begin(codec, sample_rate)
+                # Feeding blocks while the playback buffer is full, which in turn holds back the daemon
+                await asyncio.to_thread(playback_job.feed, base64.b64decode(event["data"]))
+            elif event["type"] == "error":
+                print(f"{system_color}{event['message']}")
+            elif event["type"] == "done" and not event["response"]:
+                if started:
+                    print(f"\n{system_color}The reply was cut off and will not be saved; see the daemon log for details.")
+                else:
+                    print(f"{system_color}No reply; see the daemon log for details.")
+    finally:
+        if started:
+            print()
+        else:
+            processing_task.cancel()
+            clear_processing_message()
+        if playback_job is not None:
+            playback_job.finish()
+
+async def remote_chat(args):
+    """Chat through a running daemon, keeping the terminal interface of chat()."""
+    client = DaemonClient()
+    try:
+        await client.connect()
+    except OSError as e:
+        print(f"Could not reach the cmdGPT daemon ({e}). Start one with: python cmdGPT.py --daemon")
+        return
+    try:
+        while True:
+            display_initial_title()
+            model = args.model or (None if args.resume else select_model())
+            custom_voices = load_custom_voices()
+            if args.voice is not None:
+                voice_config = custom_voices[args.voice - 1] if 0 < args.voice <= len(custom_voices) else None
+            else:
+                voice_config = select_voice(custom_voices)
+            input_mode_multiline = select_input_mode()
+            system_message = args.system
+            if not system_message and not args.resume:
+                system_message = input(f"\n{system_color}Enter a system message or press Enter for default: ")
+            opened = await client.open(model, voice_config, system_message or DEFAULT_SYSTEM_MESSAGE, args.resume,
+                                       args.context_policy, args.context_budget)
+            if opened["type"] == "error":
+                # The session to resume does not exist, so there is no stored model or system message to reuse
+                print(f"{opened['message']} Starting a new session.")
+                model = select_model()
+                if not system_message:
+                    system_message = input(f"\n{system_color}Enter a system message or press Enter for default: ")
+                opened = await client.open(model, voice_config, system_message or DEFAULT_SYSTEM_MESSAGE, None,
+                                           args.context_policy, args.context_budget)
+            args.resume = None
+            clear_screen()
+            display_short_title(opened["model"], voice_config['name'] if voice_config else None, opened["system"])
+            print_history(opened["history"])
+
+            while True:
+                user_input = read_user_input(input_mode_multiline)
+                if user_input.lower() in ["exit", "quit"]:
+                    return
+                elif user_input.lower() == "reset":
+                    break
+                elif user_input.lower() == "clear":
+                    opened = await client.clear()
+                    clear_screen()
+                    display_short_title(opened["model"], voice_config['name'] if voice_config else None, opened["system"])
+                    continue
+                await print_remote_reply(client, user_input)
+    except ConnectionError as e:
+        print(f"{system_color}Lost the connection to the cmdGPT daemon: {e}")
+    finally:
+        await client.close()
+        close_audio_player()
 
 async def chat():
-    check_and_run_getvoices()
     args = parse_args()
+    cache = get_cache(enabled=not args.no_cache)
+    tracer = get_tracer()
+    tracer.configure(args.trace, args.metrics)
+    # Record time to first token on every route, so hedge delays have samples before the first hedged turn
+    get_latency_stats()
+
+    if args.batch:
+        voice_config = None
+        if args.voice is not None:
+            custom_voices = load_custom_voices()
+            voice_config = custom_voices[args.voice - 1] if 0 < args.voice <= len(custom_voices) else None
+        await run_batch(args.batch, args.output, args.model or DEFAULT_MODEL, args.system or DEFAULT_SYSTEM_MESSAGE,
+                        voice_config, args.concurrency, args.ordered, cache)
+        return
+    if args.file:
+        if not os.path.isfile(args.file):
+            print(f"File not found: {args.file}")
+            return
+        answer = await map_reduce_file(args.file, args.model or DEFAULT_MODEL, args.instruction,
+                                       args.chunk_tokens, args.concurrency, cache)
+        print(answer if answer else "No answer; see the log for details.")
+        return
+    if args.daemon:
+        await run_daemon(args.concurrency)
+        return
+    if args.connect:
+        await remote_chat(args)
+        return
+    store = get_session_store()
+    # Scan chat_transcripts once now; pruning then runs from the in-memory manifest
+    get_retention_manager()
+
+    if args.sessions or args.search:
+        if args.search:
+            print_search_results(store.search(args.search))
+        else:
+            print_sessions(store.list_sessions())
+        store.close()
+        return
+
+    # Generates the voice catalog in the background if it is missing; the first prompt does not wait for it
+    check_and_run_getvoices()
+    resumed = store.load_session(args.resume) if args.resume else None
+    if args.resume and resumed is None:
+        print(f"Session {args.resume} not found. Starting a new session.")
 
     while True:
         display_initial_title()
 
         # Select model
-        model = args.model if args.model else select_model()
+        if args.model:
+            model = args.model
+        elif resumed and resumed["model"]:
+            model = resumed["model"]
+        else:
+            model = select_model()
 
         # Load custom voices and handle voice configuration
         custom_voices = load_custom_voices()
-        if args.voice is not None:
+        if resumed and args.voice is None:
+            voice_config = next((voice for voice in custom_voices if voice['name'] == resumed["voice"]), None)
+        elif args.voice is not None:
             try:
                 voice_config = custom_voices[args.voice - 1]
             except IndexError:
                 print("Invalid voice option. Defaulting to No Voice.")
                 voice_config = None
         else:
-            voice_config = select_voice()
+            voice_config = select_voice(custom_voices)
 
-        # Function to select input mode
-        def select_input_mode():
-            print("\nSelect input mode:")
-            print("1. Standard (Single line input)")
-            print("2. Multi-line (Type 'end' on a new line to finish)")
-            choice = input("Enter your choice (default is 1): ")
-            return choice.strip() == "2"  # Returns True for multi-line, False for standard
+        # Keep one TTS connection open for the whole conversation with this voice
+        tts_session = TTSSession(voice_config) if voice_config else None
+        if tts_session:
+            # Load the audio libraries and open the output device while the user is still typing
+            threading.Thread(target=get_audio_player, args=(parse_output_format(tts_session.output_format)[1],),
+                             daemon=True).start()
 
         # Select input mode
         input_mode_multiline = select_input_mode()
 
         # Handling system message
-        system_message = args.system if args.system else input(f"\n{system_color}Enter a system message or press Enter for default: ")
+        if resumed and resumed["messages"] and resumed["messages"][0]["role"] == "system":
+            system_message = resumed["messages"][0]["content"]
+        else:
+            system_message = args.system if args.system else input(f"\n{system_color}Enter a system message or press Enter for default: ")
         if not system_message:
-            system_message = "You are a helpful assistant who responds very accurately, VERY concisely, and intelligently. Respond with an element of reddit/4chan humor but keep it professional."
+            system_message = DEFAULT_SYSTEM_MESSAGE
 
         clear_screen()
         display_short_title(model, voice_config['name'] if voice_config else None, system_message)
-        messages = [{"role": "system", "content": system_message}]
-        last_saved_index = 0
+        context = ConversationContext(model, system_message, args.context_policy, args.context_budget)
+        messages = context.messages
+        if resumed:
+            # Restore the stored messages; they are already saved, so only new ones get written
+            for message in resumed["messages"][1:]:
+                context.add(message)
+            session_id = resumed["id"]
+            last_saved_index = len(messages)
+            print_history(messages)
+            resumed = None
+        else:
+            session_id = new_session_id()
+            last_saved_index = 0
+        store.start_session(session_id, model, voice_config['name'] if voice_config else None)
 
         while True:
-            if input_mode_multiline:
-                # Multi-line input with reset handling
-                print(f"\n{user_color}Enter your text (type 'end' on a new line to finish, or type 'reset' to restart):")
-                user_input_lines = []
-                while True:
-                    line = input(f"{user_color}")
-                    if line.lower() == "end":
-                        break
-                    elif line.lower() == "reset":
-                        user_input = "reset"
-                        break
-                    user_input_lines.append(line)
-                if line.lower() != "reset":
-                    user_input = "\n".join(user_input_lines)
-            else:
-                # Standard single line input
-                user_input = input(f"\n{user_color}You: ")
+            # Open the API connection while the user is still typing
+            get_client().warm_up_in_background()
+
+            user_input = read_user_input(input_mode_multiline)
 
             if user_input.lower() in ["exit", "quit"]:
-                save_chat_transcript(messages, last_saved_index)
+                save_session(session_id, messages, last_saved_index, model, voice_config)
+                if tts_session:
+                    await tts_session.close()
+                # Let queued speech finish before releasing the audio device
+                close_audio_player()
+                # Wait for audio files still being saved so their paths reach the session store
+                await asyncio.get_running_loop().shutdown_default_executor()
+                store.close()
+                get_latency_stats().save()
+                tracer.close()
+                if args.stats:
+                    print_stats(tracer.summary())
+                logging.info(f"Cache stats: {cache.stats()}")
                 return
             elif user_input.lower() == "reset":
+                if tts_session:
+                    await tts_session.close()
                 break  # Break the inner loop to restart selections
             elif user_input.lower() == "clear":
-                save_chat_transcript(messages, last_saved_index)
-                messages = [{"role": "system", "content": system_message}]
-                last_saved_index = len(messages)
+                save_session(session_id, messages, last_saved_index, model, voice_config)
+                context = ConversationContext(model, system_message, args.context_policy, args.context_budget)
+                messages = context.messages
+                session_id = new_session_id()
+                store.start_session(session_id, model, voice_config['name'] if voice_config else None)
+                last_saved_index = 0
                 clear_screen()
                 display_short_title(model, voice_config['name'] if voice_config else None, system_message)
                 continue
+            elif user_input.startswith("/attach"):
+                attached = await attach_file(user_input, model, args, cache)
+                if attached:
+                    context.add({"role": "user", "content": attached[0]})
+                    context.add({"role": "assistant", "content": attached[1]})
+                    save_session(session_id, messages, last_saved_index, model, voice_config)
+                    last_saved_index = len(messages)
+                continue
+            elif user_input.startswith("/recall"):
+                await recall_earlier_answers(user_input)
+                continue
 
-            messages.append({"role": "user", "content": user_input})
+            recalled = await offer_recalled_answer(user_input) if args.dedupe else None
+            context.add({"role": "user", "content": user_input})
+            request_messages = context.request_messages()
+            trace = tracer.start_turn(session_id)
 
-            processing_task = asyncio.create_task(animate_processing(f"{system_color}Processing OpenAI Chat"))
-            response = await asyncio.to_thread(interact_with_model, model, messages)
-            processing_task.cancel()
-            clear_processing_message()
+            if recalled is not None:
+                print(f"{cmdGPT_color}cmdGPT: {recalled}")
+                response = recalled
+                audio_sink = await speak_text(tts_session, recalled, cache) if tts_session else None
+            else:
+                response, audio_sink = await respond(model, request_messages, tts_session, cache,
+                                                     parse_models(args.models, model), args.route)
 
             if response:
-                if voice_config:
-                    audio_processing_task = asyncio.create_task(animate_processing(f"{system_color}Processing Audio"))
-
-                    def stop_audio_animation():
-                        audio_processing_task.cancel()
-                        clear_processing_message()
-
-                    audio_buffer = await stream_audio_websocket(voice_config, response, stop_audio_animation)
+                context.add({"role": "assistant", "content": response})
+                save_session(session_id, messages, last_saved_index, model, voice_config)
+                last_saved_index = len(messages)
+                tracing.mark("persistence_done")
 
-                    if audio_buffer is not None:
-                        response_filename = sanitize_for_filename(response)
-                        audio_filename = f"{response_filename}_{datetime.now().strftime('%Y%m%d%H%M%S')}.mp3"
-                        save_audio_file(audio_buffer, audio_filename)
-                        manage_audio_files()
+                if voice_config:
+                    if audio_sink is not None:
+                        # Encoding and file management run on a worker thread, off the playback path
+                        asyncio.get_running_loop().run_in_executor(
+                            None, persist_audio, audio_sink, response, session_id, len(messages) - 1, trace, cache)
                     else:
-                        print("An error occurred in audio streaming: audio_buffer is None")
-
-                    print(f"{cmdGPT_color}cmdGPT: {response}")
-                else:
-                    print(f"{cmdGPT_color}cmdGPT: {response}")
-
-                messages.append({"role": "assistant", "content": response})
-                save_chat_transcript(messages, last_saved_index)
-                last_saved_index = len(messages)
+                        print("An error occurred in audio streaming: audio_sink is None")
 
 if __name__ == "__main__":
     asyncio.run(chat())
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+from api_interaction import interact_with_model
+
+# Context window sizes in tokens for the models offered by select_model
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-vision-preview": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_LIMIT = 8192
+# Tokens kept free for the reply
+REPLY_RESERVE = 4096
+# Approximate per-message overhead of the chat format
+MESSAGE_OVERHEAD = 4
+
+def get_context_budget(model):
+    """Return the prompt token budget for a model; CMDGPT_CONTEXT_BUDGET overrides it."""
+    if os.getenv("CMDGPT_CONTEXT_BUDGET"):
+        return int(os.getenv("CMDGPT_CONTEXT_BUDGET"))
+    # Match the longest known prefix so dated model names like gpt-4o-2024-05-13 resolve
+    matches = [name for name in MODEL_CONTEXT_LIMITS if model.startswith(name)]
+    limit = MODEL_CONTEXT_LIMITS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_LIMIT
+    return max(limit - REPLY_RESERVE, limit // 2)
+
+_token_counters = {}
+_token_counters_lock = threading.Lock()
+
+def get_token_counter(model):
+    """Return a function counting the tokens of a text, using tiktoken when it is installed.
+
+    The counter is loaded once per model, so an encoding that cannot be
+    downloaded is not retried for every new context.
+    """
+    with _token_counters_lock:
+        if model not in _token_counters:
+            _token_counters[model] = load_token_counter(model)
+        return _token_counters[model]
+
+def load_token_counter(model):
+    # Imported on first use; loading tiktoken takes longer than the rest of startup
+    estimate = lambda text: len(text) // 4 + 1
+    try:
+        import tiktoken
+    except ImportError:
+        return estimate
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The first use downloads the encoding, which fails offline
+        logging.warning(f"Could not load the tiktoken encoding for {model}, estimating token counts instead: {e}")
+        return estimate
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+class SlidingWindowPolicy:
+    """Send the newest messages that fit in the budget, optionally pinning the system message.
+
+    The window only ever moves forward, so its token total is maintained
+    incrementally as messages are added and evicted.
+    """
+
+    def __init__(self, pin_system=True):
+        self.pin_system = pin_system
+        self.window_start = 0
+        self.window_tokens = 0
+
+    def reset(self, context):
+        self.window_start = 1 if self.pinned(context) else 0
+        self.window_tokens = sum(context.token_counts[self.window_start:])
+
+    def pinned(self, context):
+        return self.pin_system and bool(context.messages) and context.messages[0]["role"] == "system"
+
+    def extra_tokens(self):
+        """Tokens used by messages the policy adds to the request, beyond the window."""
+        return 0
+
+    def on_add(self, context, index):
+        self.window_tokens += context.token_counts[index]
+        available = context.budget - self.extra_tokens()
+        if self.pinned(context):
+            available -= context.token_counts[0]
+        evicted = []
+        # Always keep the newest message, even if it alone exceeds the budget
+        while self.window_tokens > available and self.window_start < len(context.messages) - 1:
+            self.window_tokens -= context.token_counts[self.window_start]
+            evicted.append(context.messages[self.window_start])
+            self.window_start += 1
+        if evicted:
+            self.on_evict(context, evicted)
+
+    def on_evict(self, context, evicted):
+        """Called with the messages that just left the window."""
+        logging.debug(f"Context window evicted {len(evicted)} messages")
+
+    def build(self, context):
+        pinned = context.messages[:1] if self.pinned(context) and self.window_start > 0 else []
+        return pinned + context.messages[self.window_start:]
+
+class SummarizingPolicy(SlidingWindowPolicy):
+    """A sliding window that summarizes evicted turns in the background and sends the summary along.
+
+    Until a summary is ready the request simply omits the evicted turns, so the
+    turn loop never waits on summarization.
+    """
+
+    def __init__(self, pin_system=True, summary_model=None):
+        super().__init__(pin_system)
+        self.summary_model = summary_model
+        self.summary = ""
+        self.summary_tokens = 0
+        self.pending = []
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    def extra_tokens(self):
+        return self.summary_tokens
+
+    def on_evict(self, context, evicted):
+        super().on_evict(context, evicted)
+        with self.lock:
+            self.pending.extend(evicted)
+            if self.summarizing:
+                return
+            self.summarizing = True
+        threading.Thread(target=self._summarize, args=(context,), daemon=True).start()
+
+    def _summarize(self, context):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.summarizing = False
+                    return
+                evicted, self.pending = self.pending, []
+                summary = self.summary
+            transcript = "\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in evicted)
+            prompt = [
+                {"role": "system", "content": "Summarize the conversation below in a few sentences, keeping facts, names, decisions and open questions. Reply with the summary only."},
+                {"role": "user", "content": f"Earlier summary:\n{summary}\n\nNew turns:\n{transcript}" if summary else transcript},
+            ]
+            new_summary = interact_with_model(self.summary_model or context.model, prompt)
+            if new_summary:
+                with self.lock:
+                    self.summary = new_summary
+                    self.summary_tokens = context.count_tokens(new_summary) + MESSAGE_OVERHEAD
+
+    def build(self, context):
+        messages = super().build(context)
+        if not self.summary:
+            return messages
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}
+        if self.pinned(context):
+            return messages[:1] + [summary_message] + messages[1:]
+        return [summary_message] + messages
+
+CONTEXT_POLICIES = {
+    "window": SlidingWindowPolicy,
+    "summarize": SummarizingPolicy,
+}
+
+class ConversationContext:
+    """The full message history of a chat plus the token-budgeted window that is sent to the model.
+
+    messages holds every message (used for transcripts); request_messages()
+    returns what the policy selects for the next request.
+    """
+
+    def __init__(self, model, system_message, policy="window", budget=None):
+        self.model = model
+        self.count_tokens = get_token_counter(model)
+        self.budget = budget or get_context_budget(model)
+        self.policy = CONTEXT_POLICIES[policy]() if isinstance(policy, str) else policy
+        self.messages = []
+        self.token_counts = []
+        self.add({"role": "system", "content": system_message})
+
+    def add(self, message):
+        """Append a message, counting its tokens once."""
+        self.messages.append(message)
+        self.token_counts.append(self.count_tokens(message["content"]) + MESSAGE_OVERHEAD)
+        if len(self.messages) == 1:
+            self.policy.reset(self)
+        else:
+            self.policy.on_add(self, len(self.messages) - 1)
+
+    def request_messages(self):
+        """Return the messages to send with the next request."""
+        return self.policy.build(self)
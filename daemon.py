@@ -0,0 +1,366 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from api_interaction import stream_model_response, get_client, StreamInterrupted
+from cache import get_cache, completion_key, audio_key
+from chat_management import AudioSink, save_session, persist_audio
+from context_manager import ConversationContext
+from retention import get_retention_manager
+from session_store import get_session_store, new_session_id
+from voice_handler import TTSSession, chunk_text_by_sentence
+
+# Unix socket the daemon listens on; platforms without Unix sockets use DAEMON_PORT on localhost instead
+DAEMON_SOCKET = os.getenv("CMDGPT_DAEMON_SOCKET", "cmdgpt.sock")
+DAEMON_PORT = int(os.getenv("CMDGPT_DAEMON_PORT", 8765))
+# Messages buffered for a client before that client's reply generation pauses
+CLIENT_QUEUE_SIZE = 256
+# Largest JSON line accepted, e.g. a long pasted prompt
+LINE_LIMIT = 16 * 1024 * 1024
+AUDIO_MESSAGE_BYTES = 64 * 1024
+
+def use_unix_socket():
+    return hasattr(asyncio, "start_unix_server")
+
+class TTSPool:
+    """Open TTS sessions shared by all chats, at most max_per_voice per voice.
+
+    A TTS session synthesizes one reply at a time, so a chat borrows one for a
+    turn and gives it back afterwards; chats using the same voice wait in turn
+    once all of that voice's sessions are busy.
+    """
+
+    def __init__(self, max_per_voice=2):
+        self.max_per_voice = max_per_voice
+        self.idle = {}
+        self.counts = {}
+
+    @asynccontextmanager
+    async def borrow(self, voice_config):
+        key = json.dumps(voice_config, sort_keys=True)
+        idle = self.idle.setdefault(key, asyncio.Queue())
+        if idle.empty() and self.counts.get(key, 0) < self.max_per_voice:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            session = TTSSession(voice_config)
+        else:
+            session = await idle.get()
+        try:
+            yield session
+        finally:
+            idle.put_nowait(session)
+
+    async def close(self):
+        for idle in self.idle.values():
+            while not idle.empty():
+                await idle.get_nowait().close()
+
+class DaemonSession:
+    """One chat hosted by the daemon, with its own model, voice and conversation."""
+
+    def __init__(self, session_id, model, voice_config, system_message, policy="window", budget=None):
+        self.session_id = session_id
+        self.model = model
+        self.voice_config = voice_config
+        self.system_message = system_message
+        self.policy = policy
+        self.budget = budget
+        self.context = ConversationContext(model, system_message, policy, budget)
+        self.last_saved_index = 0
+
+    @property
+    def messages(self):
+        return self.context.messages
+
+    def save(self):
+        save_session(self.session_id, self.messages, self.last_saved_index, self.model, self.voice_config)
+        self.last_saved_index = len(self.messages)
+
+class CmdGPTDaemon:
+    """Hosts many chats in one process over a local socket.
+
+    Clients speak newline-delimited JSON. All chats share the HTTP connection
+    pool, the TTS sessions, the result cache, the session store and file
+    retention. At most max_concurrent_turns replies are generated at once; a
+    chat has at most one turn in flight and waiting turns are admitted in
+    arrival order, so no chat can starve the others. Each client has a bounded
+    outgoing queue, so a slow client only slows down its own replies.
+    """
+
+    def __init__(self, max_concurrent_turns=8, max_tts_per_voice=2):
+        self.cache = get_cache()
+        self.store = get_session_store()
+        get_retention_manager()
+        self.turn_slots = asyncio.Semaphore(max_concurrent_turns)
+        self.tts_pool = TTSPool(max_tts_per_voice)
+        self.clients = set()
+
+    async def start(self, path=DAEMON_SOCKET, port=DAEMON_PORT):
+        """Start listening and return the server with a description of its address."""
+        if use_unix_socket():
+            if os.path.exists(path):
+                try:
+                    _, writer = await asyncio.open_unix_connection(path)
+                    writer.close()
+                    raise RuntimeError(f"A cmdGPT daemon is already listening on {path}")
+                except ConnectionError:
+                    # Left behind by a daemon that did not shut down cleanly
+                    os.remove(path)
+            server = await asyncio.start_unix_server(self.handle_client, path, limit=LINE_LIMIT)
+            return server, path
+        server = await asyncio.start_server(self.handle_client, "127.0.0.1", port, limit=LINE_LIMIT)
+        return server, f"127.0.0.1:{port}"
+
+    async def handle_client(self, reader, writer):
+        outgoing = asyncio.Queue(CLIENT_QUEUE_SIZE)
+        writer_task = asyncio.create_task(self._write_messages(outgoing, writer))
+        session = None
+        self.clients.add(asyncio.current_task())
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                kind = request.get("type")
+                if kind == "open":
+                    if session:
+                        await asyncio.to_thread(session.save)
+                    # Loading a stored session waits for the store's pending writes; other chats keep going meanwhile
+                    session = await asyncio.to_thread(self.open_session, request)
+                    if session is None:
+                        await outgoing.put({"type": "error", "message": f"Session {request.get('session_id')} not found."})
+                    else:
+                        await outgoing.put(self.opened_message(session))
+                elif kind == "clear" and session:
+                    await asyncio.to_thread(session.save)
+                    # Building the context loads the token counter, so it stays off the event loop as in open
+                    session = await asyncio.to_thread(DaemonSession, new_session_id(), session.model,
+                                                      session.voice_config, session.system_message,
+                                                      session.policy, session.budget)
+                    self.store.start_session(session.session_id, session.model, self.voice_name(session))
+                    await outgoing.put(self.opened_message(session))
+                elif kind == "message" and session:
+                    await self.run_turn(session, request["content"], outgoing.put)
+                elif kind == "close":
+                    break
+                else:
+                    await outgoing.put({"type": "error", "message": f"Unexpected {kind} request"})
+        except (ConnectionError, KeyError, ValueError) as e:
+            logging.error(f"Error in handle_client: {e}")
+        except asyncio.CancelledError:
+            # The daemon is shutting down; the chat is still saved below
+            pass
+        finally:
+            self.clients.discard(asyncio.current_task())
+            if session:
+                await asyncio.to_thread(session.save)
+            await outgoing.put(None)
+            await writer_task
+            writer.close()
+
+    async def _write_messages(self, outgoing, writer):
+        """Send queued messages to the client until None is queued."""
+        connected = True
+        while (message := await outgoing.get()) is not None:
+            if not connected:
+                # Keep draining so producers never block on a client that has gone away
+                continue
+            try:
+                writer.write(json.dumps(message).encode("utf-8") + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    @staticmethod
+    def voice_name(session):
+        return session.voice_config['name'] if session.voice_config else None
+
+    def open_session(self, request):
+        """Create a chat from an open request, restoring a stored session if one is named.
+
+        Returns None if the named session does not exist and the request gives no model to start a new one with.
+        """
+        stored = self.store.load_session(request["session_id"]) if request.get("session_id") else None
+        model = request.get("model") or (stored and stored["model"])
+        if not model:
+            return None
+        system_message = request.get("system")
+        if stored and stored["messages"] and stored["messages"][0]["role"] == "system":
+            system_message = stored["messages"][0]["content"]
+        session = DaemonSession(stored["id"] if stored else new_session_id(), model, request.get("voice"),
+                                system_message, request.get("context_policy", "window"), request.get("context_budget"))
+        if stored:
+            for message in stored["messages"][1:]:
+                session.context.add(message)
+            session.last_saved_index = len(session.messages)
+        self.store.start_session(session.session_id, model, self.voice_name(session))
+        return session
+
+    @staticmethod
+    def opened_message(session):
+        return {"type": "opened", "session_id": session.session_id, "model": session.model,
+                "system": session.system_message, "history": session.messages[1:]}
+
+    async def run_turn(self, session, content, send):
+        """Answer one message of a chat, streaming text and audio to its client."""
+        session.context.add({"role": "user", "content": content})
+        request_messages = session.context.request_messages()
+        async with self.turn_slots:
+            response, audio_sink = await self.respond(session, request_messages, send)
+        if response:
+            session.context.add({"role": "assistant", "content": response})
+            await asyncio.to_thread(session.save)
+            if audio_sink is not None:
+                asyncio.get_running_loop().run_in_executor(
+                    None, persist_audio, audio_sink, response, session.session_id, len(session.messages) - 1,
+                    None, self.cache)
+        await send({"type": "done", "response": response})
+
+    async def respond(self, session, request_messages, send):
+        """Produce the reply from the cache or the model, and its audio if the chat has a voice."""
+        cached_response = self.cache.get_text(completion_key(session.model, request_messages))
+        if cached_response is not None:
+            await send({"type": "delta", "text": cached_response})
+        if not session.voice_config:
+            if cached_response is not None:
+                return cached_response, None
+            return await self.stream_text(session.model, request_messages, send), None
+
+        async with self.tts_pool.borrow(session.voice_config) as tts_session:
+            output_format = tts_session.output_format
+
+            async def send_audio(audio_data):
+                audio_view = memoryview(audio_data)
+                for start in range(0, len(audio_view), AUDIO_MESSAGE_BYTES):
+                    chunk = audio_view[start:start + AUDIO_MESSAGE_BYTES]
+                    await send({"type": "audio", "format": output_format, "data": base64.b64encode(chunk).decode()})
+
+            if cached_response is not None:
+                cached_path = self.cache.get_path(audio_key(session.voice_config, output_format, cached_response))
+                if cached_path is not None:
+                    return cached_response, await self.send_audio_file(cached_path, output_format, send_audio)
+                response = cached_response
+                audio_sink = await tts_session.synthesize_text(response, play=False, on_audio=send_audio)
+            else:
+                text_queue = asyncio.Queue()
+
+                async def queued_text():
+                    while (delta := await text_queue.get()) is not None:
+                        yield delta
+
+                tts_task = asyncio.create_task(tts_session.synthesize(
+                    chunk_text_by_sentence(queued_text()), play=False, on_audio=send_audio))
+                try:
+                    response = await self.stream_text(session.model, request_messages, send, text_queue.put_nowait)
+                finally:
+                    text_queue.put_nowait(None)
+                audio_sink = await tts_task
+        if audio_sink is not None and not response:
+            audio_sink.discard()
+            audio_sink = None
+        if audio_sink is not None:
+            # Copied into the cache by persist_audio, off the event loop
+            audio_sink.cache_key = audio_key(session.voice_config, output_format, response)
+        return response, audio_sink
+
+    @staticmethod
+    async def send_audio_file(path, output_format, send_audio):
+        """Send cached audio to a client a block at a time and return a copy of it in a new AudioSink for saving."""
+        audio_sink = AudioSink(output_format)
+        try:
+            with open(path, "rb") as file:
+                while audio_data := await asyncio.to_thread(file.read, AUDIO_MESSAGE_BYTES):
+                    audio_sink.write(audio_data)
+                    await send_audio(audio_data)
+        except BaseException:
+            audio_sink.discard()
+            raise
+        audio_sink.finish()
+        return audio_sink
+
+    async def stream_text(self, model, request_messages, send, on_delta=None):
+        """Stream the reply to the client and return it, or "" if it broke off partway so the turn is not saved."""
+        parts = []
+        try:
+            async for delta in stream_model_response(model, request_messages, self.cache):
+                parts.append(delta)
+                if on_delta:
+                    on_delta(delta)
+                await send({"type": "delta", "text": delta})
+        except StreamInterrupted:
+            return ""
+        return "".join(parts)
+
+    async def close(self):
+        """Disconnect the clients, saving their chats, and release the shared resources."""
+        for client in list(self.clients):
+            client.cancel()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        await self.tts_pool.close()
+        await asyncio.get_running_loop().shutdown_default_executor()
+        self.store.close()
+
+async def run_daemon(max_concurrent_turns=8, path=DAEMON_SOCKET, port=DAEMON_PORT):
+    """Serve chats until interrupted."""
+    daemon = CmdGPTDaemon(max_concurrent_turns)
+    server, address = await daemon.start(path, port)
+    get_client().warm_up_in_background()
+    print(f"cmdGPT daemon listening on {address}. Press Ctrl+C to stop.")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await daemon.close()
+        if use_unix_socket() and os.path.exists(path):
+            os.remove(path)
+        logging.info(f"Cache stats: {daemon.cache.stats()}")
+
+class DaemonClient:
+    """The client side of the daemon protocol."""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, path=DAEMON_SOCKET, port=DAEMON_PORT):
+        if use_unix_socket():
+            self.reader, self.writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+        else:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port, limit=LINE_LIMIT)
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+        await self.writer.drain()
+
+    async def receive(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("The cmdGPT daemon closed the connection")
+        return json.loads(line)
+
+    async def open(self, model, voice_config, system_message, session_id=None, context_policy="window", context_budget=None):
+        """Start (or resume) a chat and return the daemon's opened message."""
+        await self.send({"type": "open", "model": model, "voice": voice_config, "system": system_message,
+                         "session_id": session_id, "context_policy": context_policy, "context_budget": context_budget})
+        return await self.receive()
+
+    async def clear(self):
+        await self.send({"type": "clear"})
+        return await self.receive()
+
+    async def send_message(self, content):
+        """Send a message and yield the daemon's reply events up to and including the final done or error."""
+        await self.send({"type": "message", "content": content})
+        while True:
+            event = await self.receive()
+            yield event
+            if event["type"] in ("done", "error"):
+                return
+
+    async def close(self):
+        if self.writer is not None:
+            try:
+                await self.send({"type": "close"})
+                self.writer.close()
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
@@ -0,0 +1,11 @@
+import os
+
+ELEVENLABS_BASE_URL = "https://api.elevenlabs.io"
+
+def get_elevenlabs_base_url():
+    """Return the ElevenLabs API base URL, overridden by ELEVENLABS_BASE_URL when it is set."""
+    return os.getenv("ELEVENLABS_BASE_URL", ELEVENLABS_BASE_URL).rstrip("/")
+
+def get_elevenlabs_websocket_url():
+    """Return the ElevenLabs websocket base URL, derived from the API base URL."""
+    return get_elevenlabs_base_url().replace("https://", "wss://", 1).replace("http://", "ws://", 1)
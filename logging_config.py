@@ -1,16 +1,175 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import time
 from datetime import datetime
+import tracing
 
-def setup_logging():
-    """Set up logging with a file handler."""
-    log_filename = get_current_log_filename()
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-    logging.basicConfig(filename=log_filename, level=logging.DEBUG)
+LOG_DIRECTORY = os.getenv("CMDGPT_LOG_DIR", "logs")
+LOG_FILE_PREFIX = "cmdgptlog"
+# Level of everything not listed in CMDGPT_LOG_LEVELS
+DEFAULT_LOG_LEVEL = os.getenv("CMDGPT_LOG_LEVEL", "DEBUG")
+# Per-module levels, e.g. "voice_handler=INFO,websockets=WARNING"
+MODULE_LOG_LEVELS = os.getenv("CMDGPT_LOG_LEVELS", "")
+MAX_FILE_BYTES = int(os.getenv("CMDGPT_LOG_MAX_BYTES", 10 * 1024 * 1024))
+MAX_FILE_AGE_SECONDS = int(os.getenv("CMDGPT_LOG_MAX_AGE", 24 * 3600))
+MAX_TOTAL_BYTES = int(os.getenv("CMDGPT_LOG_TOTAL_BYTES", 100 * 1024 * 1024))
 
-def get_current_log_filename():
-    """Generates a filename for the current log file based on the date and time."""
-    # Including hours, minutes, and seconds in the filename
-    return datetime.now().strftime("logs/cmdgptlog%Y%m%d%H%M%S.txt")
+_listener = None
 
+def parse_module_levels(value):
+    """Parse "module=LEVEL,module=LEVEL" into {module: level number}, ignoring malformed entries."""
+    levels = {}
+    for entry in value.split(","):
+        name, _, level = entry.partition("=")
+        level = logging.getLevelName(level.strip().upper())
+        if name.strip() and isinstance(level, int):
+            levels[name.strip()] = level
+    return levels
+
+class ModuleLevelFilter(logging.Filter):
+    """Drops records below the level configured for the module that logged them.
+
+    Most of cmdGPT logs through the root logger, so the level is looked up by
+    the source module as well as by the top-level logger name.
+    """
+
+    def __init__(self, levels, default_level):
+        super().__init__()
+        self.levels = levels
+        self.default_level = default_level
+
+    def filter(self, record):
+        level = self.levels.get(record.module, self.levels.get(record.name.split(".")[0], self.default_level))
+        return record.levelno >= level
+
+class TurnContextFilter(logging.Filter):
+    """Tags records with the session and turn being traced in the logging thread's context."""
+
+    def filter(self, record):
+        trace = tracing.current_trace()
+        record.session_id = trace.session_id if trace else None
+        record.turn = trace.turn if trace else None
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "thread": record.threadName,
+            "session_id": getattr(record, "session_id", None),
+            "turn": getattr(record, "turn", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RotatingLogHandler(logging.handlers.BaseRotatingHandler):
+    """Writes to a new timestamped file once the current one is too big or too old.
+
+    After each rotation the oldest log files are deleted until all of them
+    together fit within max_total_bytes.
+    """
+
+    def __init__(self, directory=LOG_DIRECTORY, max_bytes=MAX_FILE_BYTES,
+                 max_age_seconds=MAX_FILE_AGE_SECONDS, max_total_bytes=MAX_TOTAL_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.max_total_bytes = max_total_bytes
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(get_current_log_filename(directory), "a", encoding="utf-8", delay=True)
+        self.opened_at = time.time()
+        self.prune()
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            return False
+        if time.time() - self.opened_at >= self.max_age_seconds:
+            return True
+        position = self.stream.tell()
+        return position > 0 and position + len(self.format(record)) + 1 > self.max_bytes
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.baseFilename = os.path.abspath(get_current_log_filename(self.directory))
+        self.opened_at = time.time()
+        self.prune()
+
+    def prune(self):
+        """Delete the oldest log files until the directory is within the total size cap."""
+        files = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.startswith(LOG_FILE_PREFIX) and entry.path != self.baseFilename:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+        total = sum(size for _, _, size in files)
+        for _, path, size in sorted(files):
+            if total <= self.max_total_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+def setup_logging(directory=LOG_DIRECTORY, level=DEFAULT_LOG_LEVEL, module_levels=MODULE_LOG_LEVELS):
+    """Send all logging through a queue to a background thread that writes rotating JSON log files.
+
+    Logging calls only enqueue the record, so they never wait on disk I/O,
+    not even on the asyncio loop thread.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    levels = parse_module_levels(module_levels)
+    default_level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    if not isinstance(default_level, int):
+        default_level = logging.DEBUG
+
+    file_handler = RotatingLogHandler(directory)
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ModuleLevelFilter(levels, default_level))
+    queue_handler.addFilter(TurnContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    # The root logger lets everything through; the filter applies the configured levels
+    root.setLevel(min([default_level, *levels.values()]))
+    for name, module_level in levels.items():
+        if name != "root":
+            logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Write out the records still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+def get_current_log_filename(directory=LOG_DIRECTORY):
+    """Generates a filename for a new log file based on the date and time."""
+    # Microseconds keep files apart when several rotations happen within a second
+    return os.path.join(directory, datetime.now().strftime(f"{LOG_FILE_PREFIX}%Y%m%d%H%M%S%f.jsonl"))
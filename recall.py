@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from api_interaction import get_client
+from session_store import get_session_store
+
+RECALL_DIRECTORY = os.path.join("chat_transcripts", "recall")
+# Embedder used for new indexes: "hashing" (local, the default) or "openai[:model]"
+RECALL_EMBEDDER = os.getenv("CMDGPT_RECALL_EMBEDDER", "hashing")
+# Cosine similarity above which an earlier question counts as asked before
+DUPLICATE_THRESHOLD = float(os.getenv("CMDGPT_RECALL_THRESHOLD", "0.9"))
+RECALL_RESULTS = 5
+# Rows scored per step of a search, so the float32 copy of a block stays small and in cache
+SEARCH_BLOCK_ROWS = 4096
+# Unit vectors are stored as int8 with their components scaled by this
+QUANTIZATION_SCALE = 127
+WORD = re.compile(r"\w+")
+
+def normalize(vectors):
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class HashingEmbedder:
+    """A local embedder that hashes words and word pairs into a fixed number of dimensions.
+
+    It needs no model or network access. Questions that share most of their
+    words score high, which is what spotting a re-asked question needs.
+    """
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def embed(self, texts):
+        import numpy as np
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD.findall(text.lower())
+            for feature in words + [f"{first} {second}" for first, second in zip(words, words[1:])]:
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                # The top bit picks the sign, so colliding features tend to cancel out rather than add up
+                vectors[row, digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+        return normalize(vectors)
+
+class OpenAIEmbedder:
+    """Embeds texts with the OpenAI embeddings API; better at paraphrases, but every update and search is a request."""
+
+    def __init__(self, model="text-embedding-3-small", dimensions=256):
+        self.model = model
+        self.dimensions = dimensions
+        self.name = f"openai-{model}-{dimensions}"
+
+    def embed(self, texts):
+        import numpy as np
+        response = get_client().post("/embeddings", {"model": self.model, "dimensions": self.dimensions,
+                                                     "input": [text or " " for text in texts]})
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        return normalize(np.array([item["embedding"] for item in data], dtype=np.float32))
+
+EMBEDDERS = {"hashing": HashingEmbedder, "openai": OpenAIEmbedder}
+
+def get_embedder(spec=RECALL_EMBEDDER):
+    """Return the embedder for a spec such as "hashing" or "openai:text-embedding-3-small"."""
+    name, _, model = spec.partition(":")
+    if name not in EMBEDDERS:
+        logging.warning(f"Unknown recall embedder {spec!r}; using the local hashing embedder")
+        return HashingEmbedder()
+    return EMBEDDERS[name](model) if model else EMBEDDERS[name]()
+
+class RecallIndex:
+    """A vector index of the questions answered in past sessions, for finding earlier answers.
+
+    Each row is the embedding of a user message that got an answer, quantized
+    to int8 in a file that only ever grows, next to a file with the ID of the
+    answer in the session store. New pairs are read from the session store and
+    appended on a background worker after each save. Searches memory-map the
+    vectors and score them a block at a time, so memory use stays flat as the
+    index grows.
+    """
+
+    def __init__(self, directory=RECALL_DIRECTORY, embedder=None, store=None):
+        self.directory = directory
+        self.embedder = embedder or get_embedder()
+        self.store = store or get_session_store()
+        self.vectors_path = os.path.join(directory, "vectors.i8")
+        self.ids_path = os.path.join(directory, "ids.i64")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.ids = None
+        self.vectors = None
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _load(self):
+        import numpy as np
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {"embedder": self.embedder.name, "dimensions": self.embedder.dimensions, "dtype": "int8"}
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as file:
+                saved_meta = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved_meta = None
+        if saved_meta != meta:
+            if saved_meta is not None:
+                logging.info(f"Recall index format changed from {saved_meta} to {meta}; rebuilding it")
+            for path in (self.vectors_path, self.ids_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            with open(self.meta_path, "w", encoding="utf-8") as file:
+                json.dump(meta, file)
+        row_bytes = self.embedder.dimensions
+        vector_rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        id_rows = os.path.getsize(self.ids_path) // 8 if os.path.exists(self.ids_path) else 0
+        count = min(vector_rows, id_rows)
+        # An interrupted append leaves one file longer than the other
+        for path, size in ((self.vectors_path, count * row_bytes), (self.ids_path, count * 8)):
+            with open(path, "ab") as file:
+                file.truncate(size)
+        self.ids = np.fromfile(self.ids_path, dtype=np.int64)
+        self.vectors = None
+
+    def _matrix(self):
+        """Memory-map the stored vectors; the map is reopened after each append since its size is fixed."""
+        import numpy as np
+        if self.vectors is None and len(self.ids):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.int8, mode="r",
+                                     shape=(len(self.ids), self.embedder.dimensions))
+        return self.vectors
+
+    def schedule_update(self):
+        """Index newly saved question and answer pairs in the background."""
+        self.pending.set()
+
+    def _run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            try:
+                self.update()
+            except Exception as e:
+                logging.error(f"Error updating the recall index: {e}")
+
+    def update(self, batch_size=1024):
+        """Embed and append the pairs saved since the last update."""
+        import numpy as np
+        with self.lock:
+            if self.ids is None:
+                self._load()
+            while True:
+                last_id = int(self.ids[-1]) if len(self.ids) else 0
+                pairs = self.store.question_answer_pairs(last_id, batch_size)
+                if not pairs:
+                    return
+                ids = np.array([answer_id for answer_id, _ in pairs], dtype=np.int64)
+                vectors = np.rint(self.embedder.embed([question for _, question in pairs]) * QUANTIZATION_SCALE).astype(np.int8)
+                # Vectors first: after a crash the ids file decides which rows count
+                with open(self.vectors_path, "ab") as file:
+                    file.write(vectors.tobytes())
+                with open(self.ids_path, "ab") as file:
+                    file.write(ids.tobytes())
+                self.ids = np.concatenate([self.ids, ids])
+                self.vectors = None
+
+    def search(self, query, limit=RECALL_RESULTS):
+        """Return the earlier questions most similar to a query, best first.
+
+        Each result is (score, session id, seq, question, answer, created_at), where
+        score is the cosine similarity of the two questions. If the embedder or the
+        index fails, e.g. the embeddings API is unreachable, the error is logged and
+        there are no results, so the chat carries on.
+        """
+        try:
+            return self._search(query, limit)
+        except Exception as e:
+            logging.error(f"Error in search: {e}")
+            return []
+
+    def _search(self, query, limit):
+        import numpy as np
+        self.update()
+        with self.lock:
+            matrix = self._matrix()
+            if matrix is None:
+                return []
+            query_vector = self.embedder.embed([query])[0]
+            scores = np.empty(len(matrix), dtype=np.float32)
+            for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+                block = matrix[start:start + SEARCH_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ query_vector
+            scores /= QUANTIZATION_SCALE
+            limit = min(limit, len(scores))
+            best = np.argpartition(-scores, limit - 1)[:limit]
+            best = best[np.argsort(-scores[best])]
+            answer_ids = [int(self.ids[row]) for row in best]
+            best_scores = [float(scores[row]) for row in best]
+        pairs = self.store.get_question_answer_pairs(answer_ids)
+        return [(score, *pairs[answer_id]) for score, answer_id in zip(best_scores, answer_ids) if answer_id in pairs]
+
+    def find_duplicate(self, question, threshold=DUPLICATE_THRESHOLD):
+        """Return the closest earlier (score, session id, seq, question, answer, created_at) if it is a near-duplicate, else None."""
+        results = self.search(question, 1)
+        if results and results[0][0] >= threshold:
+            return results[0]
+        return None
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_recall_index():
+    """Return the shared recall index; it is loaded on its first update or search."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = RecallIndex()
+        return _index
@@ -0,0 +1,128 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class RetentionPolicy:
+    """Limits for one type of file: how many to keep, how old they may get and how many bytes they may use.
+
+    A limit of None is not enforced.
+    """
+
+    def __init__(self, suffix, max_count=None, max_age_seconds=None, max_bytes=None):
+        self.suffix = suffix
+        self.max_count = max_count
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+
+# Matches the previous behavior of keeping the ten newest audio files; transcripts are kept.
+# Partial audio files are only left behind by interrupted runs.
+DEFAULT_POLICIES = [
+    RetentionPolicy(".mp3", max_count=10),
+    RetentionPolicy(".txt"),
+    RetentionPolicy(".part", max_age_seconds=24 * 3600),
+]
+
+class RetentionManager:
+    """Keeps the files of a directory within their retention policies.
+
+    The directory is scanned once, when the manager is created. After that the
+    in-memory manifest is updated as files are tracked, and eviction runs on a
+    background worker, so nothing on the turn loop lists or stats the directory.
+    """
+
+    def __init__(self, directory="chat_transcripts", policies=None):
+        self.directory = directory
+        self.policies = policies or DEFAULT_POLICIES
+        # suffix -> OrderedDict of path -> (modified, size), least recently written first
+        self.manifest = {policy.suffix: OrderedDict() for policy in self.policies}
+        self.total_bytes = {policy.suffix: 0 for policy in self.policies}
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self._load_manifest()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+        self.pending.set()
+
+    def _policy_for(self, path):
+        return next((policy for policy in self.policies if path.endswith(policy.suffix)), None)
+
+    def _load_manifest(self):
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and self._policy_for(entry.name):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for modified, path, size in sorted(entries):
+            self._add(path, modified, size)
+
+    def _add(self, path, modified, size):
+        suffix = self._policy_for(path).suffix
+        files = self.manifest[suffix]
+        previous = files.pop(path, None)
+        if previous:
+            self.total_bytes[suffix] -= previous[1]
+        files[path] = (modified, size)
+        self.total_bytes[suffix] += size
+
+    def track(self, path, size=None):
+        """Record a file that was just written and schedule eviction in the background."""
+        if self._policy_for(path) is None:
+            return
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+        with self.lock:
+            self._add(path, time.time(), size)
+        self.pending.set()
+
+    def _run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            try:
+                self.enforce()
+            except Exception as e:
+                logging.error(f"Error enforcing file retention: {e}")
+
+    def enforce(self):
+        """Delete the oldest files of each type until every policy is satisfied."""
+        now = time.time()
+        for policy in self.policies:
+            victims = []
+            with self.lock:
+                files = self.manifest[policy.suffix]
+                while files:
+                    path, (modified, size) = next(iter(files.items()))
+                    too_many = policy.max_count is not None and len(files) > policy.max_count
+                    too_old = policy.max_age_seconds is not None and now - modified > policy.max_age_seconds
+                    too_big = policy.max_bytes is not None and self.total_bytes[policy.suffix] > policy.max_bytes
+                    if not (too_many or too_old or too_big):
+                        break
+                    files.popitem(last=False)
+                    self.total_bytes[policy.suffix] -= size
+                    victims.append(path)
+            for path in victims:
+                try:
+                    os.remove(path)
+                    self.evicted += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.warning(f"Could not remove {path}: {e}")
+
+_manager = None
+
+def get_retention_manager():
+    """Return the shared retention manager, scanning chat_transcripts on first use."""
+    global _manager
+    if _manager is None:
+        _manager = RetentionManager()
+    return _manager
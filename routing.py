@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import textwrap
+import threading
+import time
+from collections import deque
+from itertools import zip_longest
+from api_interaction import stream_model_response, get_client, StreamInterrupted
+
+ROUTING_MODES = ["single", "hedge", "race", "fanout"]
+# Hedge delay used until a model has enough latency samples
+DEFAULT_HEDGE_DELAY = 2.0
+MIN_SAMPLES = 5
+# Kept out of cache/, whose files are all treated as cache entries
+LATENCY_STATS_PATH = os.path.join("chat_transcripts", "model_latency.json")
+
+class LatencyStats:
+    """Recent time-to-first-token samples per model.
+
+    Samples are saved between runs, so hedge delays follow each model's p95
+    from the first turn instead of starting from a guess. Every streamed
+    request adds a sample, whether or not its reply was used.
+    """
+
+    def __init__(self, path=LATENCY_STATS_PATH, window=200):
+        self.path = path
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                for model, samples in json.load(file).items():
+                    self.samples[model] = deque(samples, maxlen=window)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def record(self, model, seconds):
+        with self.lock:
+            self.samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model, fraction):
+        """Return the given percentile of a model's samples, or None if there are too few of them."""
+        with self.lock:
+            samples = sorted(self.samples.get(model, ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def hedge_delay(self, model):
+        """Return how long to wait for a model's first token before sending a hedged request."""
+        p95 = self.percentile(model, 0.95)
+        return DEFAULT_HEDGE_DELAY if p95 is None else p95
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self.lock:
+                data = {model: list(samples) for model, samples in self.samples.items()}
+            with open(self.path, "w", encoding="utf-8") as file:
+                json.dump(data, file)
+        except OSError as e:
+            logging.error(f"Error saving model latency stats: {e}")
+
+_stats = None
+
+def get_latency_stats():
+    """Return the shared per-model latency stats, loading saved samples and starting to record on first use."""
+    global _stats
+    if _stats is None:
+        _stats = LatencyStats()
+        get_client().add_first_token_listener(_stats.record)
+    return _stats
+
+class RoutedStream:
+    """Streams the reply of whichever of several requests produces a first token first.
+
+    In hedge mode the first model is asked alone, and the next fallback (or the
+    same model again if there is none) is asked only if no token arrived within
+    the hedge delay. In race mode all models are asked at once. Either way the
+    losing requests are cancelled as soon as there is a winner, whose model is
+    then available as .model.
+    """
+
+    def __init__(self, models, messages, mode="hedge", cache=None, stats=None):
+        self.models = models
+        self.messages = messages
+        self.mode = mode
+        self.cache = cache
+        self.stats = stats or get_latency_stats()
+        self.model = None
+
+    def __aiter__(self):
+        return self._stream()
+
+    async def _stream(self):
+        candidates = {}
+
+        def launch(model):
+            stream = stream_model_response(model, self.messages, self.cache)
+            candidates[asyncio.ensure_future(stream.__anext__())] = (model, stream)
+
+        if self.mode == "race":
+            for model in self.models:
+                launch(model)
+            hedges = []
+        else:
+            launch(self.models[0])
+            hedges = list(self.models[1:] or self.models[:1])
+
+        winner = None
+        try:
+            while candidates and winner is None:
+                timeout = self.stats.hedge_delay(self.models[0]) if hedges else None
+                done, _ = await asyncio.wait(candidates, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    model = hedges.pop(0)
+                    logging.info(f"No first token from {self.models[0]} after {timeout:.2f}s; hedging with {model}")
+                    launch(model)
+                    continue
+                for task in done:
+                    model, stream = candidates.pop(task)
+                    try:
+                        delta = task.result()
+                    except StopAsyncIteration:
+                        # This request failed or came back empty; a hedge, if any, goes out right away
+                        if hedges and not candidates:
+                            launch(hedges.pop(0))
+                        continue
+                    if winner is None:
+                        winner = (model, stream, delta)
+                    else:
+                        await stream.aclose()
+        finally:
+            await self._cancel(candidates)
+        if winner is None:
+            return
+        self.model, stream, delta = winner
+        try:
+            yield delta
+            async for delta in stream:
+                yield delta
+        finally:
+            await stream.aclose()
+
+    @staticmethod
+    async def _cancel(candidates):
+        """Cancel the requests still waiting for their first token."""
+        for task in candidates:
+            task.cancel()
+        await asyncio.gather(*candidates, return_exceptions=True)
+        for _, stream in candidates.values():
+            await stream.aclose()
+
+async def fan_out(models, messages, cache=None):
+    """Ask every model concurrently and return [(model, reply, seconds)] in the order of models."""
+
+    async def ask(model):
+        start = time.perf_counter()
+        parts = []
+        try:
+            async for delta in stream_model_response(model, messages, cache):
+                parts.append(delta)
+        except StreamInterrupted:
+            # A cut-off answer is shown as no answer rather than passed off as complete
+            return model, None, time.perf_counter() - start
+        return model, "".join(parts), time.perf_counter() - start
+
+    return await asyncio.gather(*(ask(model) for model in models))
+
+def format_side_by_side(answers, width=None, gap=3):
+    """Lay out several (model, reply, seconds) answers as columns of wrapped text."""
+    width = width or shutil.get_terminal_size().columns
+    column_width = max(20, (width - gap * (len(answers) - 1)) // len(answers))
+    columns = []
+    for model, reply, seconds in answers:
+        lines = [f"{model} ({seconds:.1f}s)", "-" * min(column_width, len(model) + 8)]
+        for paragraph in (reply or "(no reply)").splitlines() or [""]:
+            lines += textwrap.wrap(paragraph, column_width) or [""]
+        columns.append(lines)
+    return "\n".join((" " * gap).join(line.ljust(column_width) for line in row).rstrip()
+                     for row in zip_longest(*columns, fillvalue=""))
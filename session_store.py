@@ -0,0 +1,218 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+SESSION_DATABASE = os.path.join("chat_transcripts", "sessions.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    started_at REAL NOT NULL,
+    model TEXT,
+    voice TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL REFERENCES sessions(id),
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT,
+    voice TEXT,
+    created_at REAL NOT NULL,
+    audio_path TEXT,
+    UNIQUE (session_id, seq)
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+def new_session_id():
+    """Return a new sortable session ID, e.g. 20240513101500-3f2a."""
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:4]}"
+
+class SessionStore:
+    """A structured, searchable store of chat sessions with one record per message.
+
+    Writes are queued and applied in batches by a background thread, so the
+    turn loop never waits on the database. Reads use their own connection.
+    Full-text search uses SQLite FTS5 when it is available and falls back to
+    a plain substring match otherwise.
+    """
+
+    def __init__(self, path=SESSION_DATABASE, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        try:
+            connection.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite FTS5 is not available; session search falls back to substring matching")
+            self.fts = False
+        connection.commit()
+        connection.close()
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self._write_batches, daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL only syncs at checkpoints, not on every commit
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _write_batches(self):
+        connection = self._connect()
+        while True:
+            batch = [self.writes.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            try:
+                with connection:
+                    for item in batch:
+                        if item is None:
+                            stop = True
+                        else:
+                            connection.execute(*item)
+            except sqlite3.Error as e:
+                logging.error(f"Error writing chat sessions: {e}")
+            for _ in batch:
+                self.writes.task_done()
+            if stop:
+                connection.close()
+                return
+
+    def start_session(self, session_id, model, voice):
+        self.writes.put(("INSERT OR IGNORE INTO sessions (id, started_at, model, voice) VALUES (?, ?, ?, ?)",
+                         (session_id, time.time(), model, voice)))
+
+    def append_messages(self, session_id, messages, start_index, model, voice):
+        """Queue messages[start_index:] for writing; the index of each message is its sequence number."""
+        now = time.time()
+        for seq in range(start_index, len(messages)):
+            message = messages[seq]
+            self.writes.put(("INSERT OR IGNORE INTO messages (session_id, seq, role, content, model, voice, created_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (session_id, seq, message["role"], message["content"], model, voice, now)))
+
+    def set_audio_path(self, session_id, seq, audio_path):
+        self.writes.put(("UPDATE messages SET audio_path = ? WHERE session_id = ? AND seq = ?",
+                         (audio_path, session_id, seq)))
+
+    def flush(self):
+        """Wait until every queued write has been applied."""
+        self.writes.join()
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+
+    def load_session(self, session_id):
+        """Return a session's model, voice and messages, or None if it does not exist."""
+        self.flush()
+        connection = self._connect()
+        try:
+            session = connection.execute("SELECT model, voice FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if session is None:
+                return None
+            rows = connection.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq",
+                                      (session_id,)).fetchall()
+        finally:
+            connection.close()
+        return {
+            "id": session_id,
+            "model": session[0],
+            "voice": session[1],
+            "messages": [{"role": role, "content": content} for role, content in rows],
+        }
+
+    def list_sessions(self, limit=20):
+        """Return the most recent sessions as (id, started_at, model, voice, message count, first user message)."""
+        self.flush()
+        connection = self._connect()
+        try:
+            return connection.execute(
+                "SELECT s.id, s.started_at, s.model, s.voice, COUNT(m.id), "
+                "(SELECT content FROM messages WHERE session_id = s.id AND role = 'user' ORDER BY seq LIMIT 1) "
+                "FROM sessions s LEFT JOIN messages m ON m.session_id = s.id "
+                "GROUP BY s.id ORDER BY s.started_at DESC LIMIT ?", (limit,)).fetchall()
+        finally:
+            connection.close()
+
+    def search(self, query, limit=20):
+        """Search message contents across sessions, returning (session id, seq, role, snippet, created_at) rows."""
+        self.flush()
+        connection = self._connect()
+        try:
+            if self.fts:
+                sql = ("SELECT m.session_id, m.seq, m.role, snippet(messages_fts, 0, '[', ']', '...', 12), m.created_at "
+                       "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                       "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?")
+                try:
+                    return connection.execute(sql, (query, limit)).fetchall()
+                except sqlite3.OperationalError:
+                    # Not valid FTS query syntax; search for it as a literal phrase instead
+                    phrase = '"' + query.replace('"', '""') + '"'
+                    return connection.execute(sql, (phrase, limit)).fetchall()
+            return connection.execute(
+                "SELECT session_id, seq, role, substr(content, 1, 80), created_at FROM messages "
+                "WHERE content LIKE ? ORDER BY created_at DESC LIMIT ?", (f"%{query}%", limit)).fetchall()
+        finally:
+            connection.close()
+
+    def question_answer_pairs(self, after_id=0, limit=1000):
+        """Return up to limit (answer id, question) pairs, oldest first, for assistant messages after message after_id.
+
+        A pair is an assistant message and the user message right before it; the
+        answer id is the ID of the assistant message.
+        """
+        self.flush()
+        connection = self._connect()
+        try:
+            return connection.execute(
+                "SELECT a.id, u.content FROM messages a "
+                "JOIN messages u ON u.session_id = a.session_id AND u.seq = a.seq - 1 AND u.role = 'user' "
+                "WHERE a.role = 'assistant' AND a.id > ? ORDER BY a.id LIMIT ?", (after_id, limit)).fetchall()
+        finally:
+            connection.close()
+
+    def get_question_answer_pairs(self, answer_ids):
+        """Return {answer id: (session id, seq, question, answer, created_at)} for the given answer ids."""
+        if not answer_ids:
+            return {}
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT a.id, a.session_id, a.seq, u.content, a.content, a.created_at FROM messages a "
+                "JOIN messages u ON u.session_id = a.session_id AND u.seq = a.seq - 1 "
+                f"WHERE a.id IN ({', '.join('?' * len(answer_ids))})", list(answer_ids)).fetchall()
+        finally:
+            connection.close()
+        return {row[0]: row[1:] for row in rows}
+
+_store = None
+
+def get_session_store():
+    """Return the shared session store, opening the database on first use."""
+    global _store
+    if _store is None:
+        _store = SessionStore()
+    return _store
@@ -0,0 +1,177 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+# Stages of a chat turn, in the order they normally happen
+TURN_STAGES = [
+    "request_sent",
+    "first_byte",
+    "first_token",
+    "completion_done",
+    "tts_connect",
+    "first_audio_frame",
+    "playback_start",
+    "decode_done",
+    "persistence_done",
+    "audio_saved",
+]
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class TurnTrace:
+    """Timings and counters of one chat turn.
+
+    Each stage records the seconds since the turn started, the first time it is
+    marked. Stages may be marked from any thread.
+    """
+
+    def __init__(self, session_id, turn):
+        self.session_id = session_id
+        self.turn = turn
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def mark(self, stage):
+        with self.lock:
+            self.stages.setdefault(stage, time.perf_counter() - self.start)
+
+    def add(self, counter, amount):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "session_id": self.session_id,
+                "turn": self.turn,
+                "started_at": self.started_at,
+                "stages": dict(self.stages),
+                "counters": dict(self.counters),
+            }
+
+def current_trace():
+    """Return the trace of the turn running in this context, or None."""
+    return _current_trace.get()
+
+def mark(stage, trace=None):
+    """Mark a stage on the given trace, or on the current turn's trace if there is one."""
+    trace = trace or _current_trace.get()
+    if trace is not None:
+        trace.mark(stage)
+
+def add(counter, amount, trace=None):
+    """Add to a counter of the given trace, or of the current turn's trace if there is one."""
+    trace = trace or _current_trace.get()
+    if trace is not None:
+        trace.add(counter, amount)
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class Tracer:
+    """Collects turn traces and exports them.
+
+    Finished turns are appended to a JSONL trace file and summarized into a
+    Prometheus text-format snapshot, both optional. A turn is finished when the
+    next one starts or the tracer is closed, so stages that complete after the
+    turn loop moves on (playback, audio saving) are still included.
+    """
+
+    def __init__(self):
+        self.trace_path = None
+        self.metrics_path = None
+        self.active = None
+        self.turns = 0
+        self.stage_samples = {stage: [] for stage in TURN_STAGES}
+        self.counter_totals = {}
+        self.lock = threading.Lock()
+
+    def configure(self, trace_path=None, metrics_path=None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        for path in (trace_path, metrics_path):
+            if path and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def start_turn(self, session_id):
+        """Finish the previous turn and start tracing a new one in the current context."""
+        if self.active is not None:
+            self.finish(self.active)
+        self.turns += 1
+        self.active = TurnTrace(session_id, self.turns)
+        _current_trace.set(self.active)
+        return self.active
+
+    def finish(self, trace):
+        record = trace.to_dict()
+        with self.lock:
+            for stage, offset in record["stages"].items():
+                self.stage_samples.setdefault(stage, []).append(offset)
+            for counter, amount in record["counters"].items():
+                self.counter_totals[counter] = self.counter_totals.get(counter, 0) + amount
+        if self.trace_path:
+            try:
+                with open(self.trace_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logging.error(f"Error writing trace: {e}")
+        if self.metrics_path:
+            self.write_metrics(self.metrics_path)
+        if trace is self.active:
+            self.active = None
+
+    def summary(self):
+        """Return {stage: (count, p50, p95)} for every stage seen so far."""
+        with self.lock:
+            return {stage: (len(samples), percentile(samples, 0.5), percentile(samples, 0.95))
+                    for stage, samples in self.stage_samples.items() if samples}
+
+    def prometheus_text(self):
+        """Render the collected metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP cmdgpt_turn_stage_seconds Seconds from the start of a turn to each stage.",
+            "# TYPE cmdgpt_turn_stage_seconds summary",
+        ]
+        with self.lock:
+            for stage, samples in self.stage_samples.items():
+                if not samples:
+                    continue
+                for quantile in (0.5, 0.95):
+                    lines.append(f'cmdgpt_turn_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {percentile(samples, quantile):.6f}')
+                lines.append(f'cmdgpt_turn_stage_seconds_sum{{stage="{stage}"}} {sum(samples):.6f}')
+                lines.append(f'cmdgpt_turn_stage_seconds_count{{stage="{stage}"}} {len(samples)}')
+            lines += ["# HELP cmdgpt_turns_total Chat turns traced.", "# TYPE cmdgpt_turns_total counter",
+                      f"cmdgpt_turns_total {self.turns}"]
+            for counter, total in sorted(self.counter_totals.items()):
+                lines += [f"# TYPE cmdgpt_{counter}_total counter", f"cmdgpt_{counter}_total {total}"]
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path):
+        """Atomically replace the metrics snapshot file, e.g. for a node_exporter textfile collector."""
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as file:
+                file.write(self.prometheus_text())
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.error(f"Error writing metrics snapshot: {e}")
+
+    def close(self):
+        if self.active is not None:
+            self.finish(self.active)
+
+_tracer = None
+
+def get_tracer():
+    """Return the shared tracer."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
@@ -1,4 +1,5 @@
 import os
+import sys
 import subprocess
 import random
 import platform
@@ -10,10 +11,15 @@ from colorama import Fore, init
 init(autoreset=True)
 
 def check_and_run_getvoices():
-    """Check if 'voiceexamples.html' exists and run 'getvoices.py' if not."""
-    if not os.path.exists('voiceexamples.html'):
-        print("Running 'getvoices.py' to generate 'voiceexamples.html'...")
-        subprocess.run(['python', 'getvoices.py'])
+    """Check if 'voiceexamples.html' exists and start 'getvoices.py' in the background if not.
+
+    Returns the running process, or None if the file already exists.
+    """
+    if os.path.exists('voiceexamples.html'):
+        return None
+    print("Generating 'voiceexamples.html' in the background...")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'getvoices.py')
+    return subprocess.Popen([sys.executable, script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 def clear_screen():
     """Clears the terminal screen."""
@@ -31,6 +37,8 @@ def display_initial_title():
     print("\nInstructions:")
     print("- Type 'clear' to start a new chat.")
     print("- Type 'reset' to reset the chat and set a new system message.")
+    print("- Type '/attach PATH [instruction]' to ask about a file of any size.")
+    print("- Type '/recall QUERY' to find answers from earlier sessions.")
     print("- Type 'exit' or 'quit' to end the session.")
     print("----------------------------------------------")
 
@@ -0,0 +1,189 @@
+import html
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from elevenlabs_urls import get_elevenlabs_base_url
+
+CATALOG_DIRECTORY = os.getenv("CMDGPT_VOICE_CACHE", os.path.join("cache", "voices"))
+# How long the cached voice list is used before asking the API whether it changed
+CATALOG_TTL_SECONDS = int(os.getenv("CMDGPT_VOICE_CATALOG_TTL", 24 * 3600))
+
+HTML_HEADER = """
+<!DOCTYPE html>
+<html>
+<head>
+<title>Voice Samples</title>
+<style>
+table {
+    border-collapse: collapse;
+    width: 100%;
+}
+th, td {
+    text-align: left;
+    padding: 8px;
+}
+tr:nth-child(even) {background-color: #f2f2f2;}
+pre {
+    white-space: pre-wrap;       /* CSS formatting for pre tag */
+    margin-left: 20px;           /* Indentation for JSON */
+}
+</style>
+</head>
+<body>
+<h1>Available Voices</h1>
+<table border='1'>
+<tr>
+<th>Name</th>
+<th>Voice ID</th>
+<th>Category</th>
+<th>Labels</th>
+<th>Sample</th>
+<th>Config JSON</th>
+</tr>
+"""
+
+HTML_FOOTER = """
+</table>
+</body>
+</html>
+"""
+
+def add_indentation(text, num_spaces=4):
+    return '\n'.join(' ' * num_spaces + line for line in text.split('\n'))
+
+def write_atomically(path, write):
+    """Call write(file) on a temporary file and move it over path once it is complete."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        write(file)
+    os.replace(temp_path, path)
+
+class VoiceCatalog:
+    """The ElevenLabs voice list, cached locally with its preview samples.
+
+    The list is fetched again only when it is older than the TTL, and then
+    conditionally, so an unchanged list costs a 304 instead of a full download.
+    """
+
+    def __init__(self, directory=CATALOG_DIRECTORY, ttl_seconds=CATALOG_TTL_SECONDS, api_key=None):
+        self.directory = directory
+        self.preview_directory = os.path.join(directory, "previews")
+        self.index_path = os.path.join(directory, "index.json")
+        self.ttl_seconds = ttl_seconds
+        self.session = requests.Session()
+        self.session.headers["xi-api-key"] = api_key or os.getenv("ELEVENLABS_API_KEY", "")
+        self.url = get_elevenlabs_base_url() + "/v1/voices"
+        os.makedirs(self.preview_directory, exist_ok=True)
+
+    def load_index(self):
+        """Return the cached index, or an empty one if there is none yet."""
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"voices": [], "fetched_at": 0}
+
+    def refresh(self, force=False):
+        """Return the list of voices, asking the API for changes if the cached list has expired.
+
+        Falls back to the cached list if the API cannot be reached.
+        """
+        index = self.load_index()
+        if not force and index["voices"] and time.time() - index["fetched_at"] < self.ttl_seconds:
+            return index["voices"]
+        headers = {}
+        if index["voices"] and index.get("etag"):
+            headers["If-None-Match"] = index["etag"]
+        if index["voices"] and index.get("last_modified"):
+            headers["If-Modified-Since"] = index["last_modified"]
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=30)
+            if response.status_code == 304:
+                logging.info("Voice catalog unchanged")
+            elif response.status_code == 200:
+                index = {
+                    "voices": response.json().get("voices", []),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+                logging.info(f"Voice catalog updated with {len(index['voices'])} voices")
+            else:
+                print(f"Failed to get voices. Status code: {response.status_code}")
+                return index["voices"]
+        except requests.RequestException as e:
+            logging.error(f"Error in refresh: {e}")
+            print(f"Failed to get voices: {e}")
+            return index["voices"]
+        index["fetched_at"] = time.time()
+        write_atomically(self.index_path, lambda file: json.dump(index, file))
+        return index["voices"]
+
+    def preview_path(self, voice):
+        return os.path.join(self.preview_directory, f"{voice['voice_id']}.mp3")
+
+    def _download_preview(self, voice):
+        path = self.preview_path(voice)
+        try:
+            with self.session.get(voice["preview_url"], stream=True, timeout=30) as response:
+                response.raise_for_status()
+                with open(f"{path}.tmp", "wb") as file:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        file.write(chunk)
+            os.replace(f"{path}.tmp", path)
+            return path
+        except (requests.RequestException, OSError) as e:
+            logging.error(f"Error in _download_preview for {voice.get('name')}: {e}")
+            return None
+
+    def prefetch_previews(self, voices, max_workers=8):
+        """Download the preview samples not cached yet, a few at a time, and return {voice_id: local path}."""
+        previews = {}
+        missing = []
+        for voice in voices:
+            if not voice.get("voice_id") or not voice.get("preview_url"):
+                continue
+            if os.path.exists(self.preview_path(voice)):
+                previews[voice["voice_id"]] = self.preview_path(voice)
+            else:
+                missing.append(voice)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for voice, path in zip(missing, executor.map(self._download_preview, missing)):
+                if path:
+                    previews[voice["voice_id"]] = path
+        return previews
+
+    def write_html(self, voices, path="voiceexamples.html", previews=None):
+        """Write the voice samples page row by row, linking cached previews where there are any."""
+        previews = previews or {}
+        html_directory = os.path.dirname(os.path.abspath(path))
+
+        def write(file):
+            file.write(HTML_HEADER)
+            for position, voice in enumerate(voices):
+                voice_id = voice.get('voice_id', 'No ID')
+                labels = ', '.join(f"{key.capitalize()}: {value}" for key, value in voice.get('labels', {}).items())
+                preview_url = voice.get('preview_url', '#')
+                if voice_id in previews:
+                    preview_url = os.path.relpath(os.path.abspath(previews[voice_id]), html_directory).replace(os.sep, "/")
+                voice_config = {
+                    "name": voice.get('name', 'No name'),
+                    "voice_id": voice_id,
+                    "voice_settings": {
+                        "stability": 0.5,
+                        "similarity_boost": True
+                    }
+                }
+                formatted_json = add_indentation(json.dumps(voice_config, indent=4))
+                if position < len(voices) - 1:
+                    formatted_json += ",\n"
+                file.write(f"<tr><td>{html.escape(voice_config['name'])}</td><td>{html.escape(voice_id)}</td>"
+                           f"<td>{html.escape(voice.get('category', 'No category'))}</td><td>{html.escape(labels)}</td>"
+                           f"<td><audio controls src='{html.escape(preview_url)}'>Your browser does not support the audio element.</audio></td>"
+                           f"<td><pre>{html.escape(formatted_json)}</pre></td></tr>\n")
+            file.write(HTML_FOOTER)
+
+        write_atomically(path, write)
+        return path
@@ -1,21 +1,27 @@
 import logging
-import pyaudio
 import json
-import threading
+import re
 import base64
 import asyncio
-import websockets
-from pydub import AudioSegment
-from pydub.playback import play
-from io import BytesIO
+import time
 import os
+from audio_player import get_audio_player
+from chat_management import AudioSink
+from elevenlabs_urls import get_elevenlabs_websocket_url
+import tracing
+
+_custom_voices = {"mtime": None, "voices": []}
 
 def load_custom_voices():
-    """Load custom voice settings from a configuration file."""
+    """Load custom voice settings from a configuration file, parsing it again only when it changed."""
     config_path = "config.json"
     try:
-        with open(config_path, "r", encoding="utf-8") as file:
-            return json.load(file)
+        mtime = os.stat(config_path).st_mtime_ns
+        if mtime != _custom_voices["mtime"]:
+            with open(config_path, "r", encoding="utf-8") as file:
+                _custom_voices["voices"] = json.load(file)
+            _custom_voices["mtime"] = mtime
+        return _custom_voices["voices"]
     except FileNotFoundError:
         print("Error: config.json file not found.")
         return []
@@ -23,9 +29,10 @@ def load_custom_voices():
         print("Error: config.json is not properly formatted.")
         return []
 
-def select_voice():
+def select_voice(custom_voices=None):
     """Allow the user to select a voice option."""
-    custom_voices = load_custom_voices()
+    if custom_voices is None:
+        custom_voices = load_custom_voices()
     print("\nSelect a voice or type '0' for no voice:")
     print("0. No Voice")
     for i, voice in enumerate(custom_voices, 1):
@@ -41,65 +48,334 @@ def select_voice():
         print("Invalid choice, defaulting to No Voice.")
         return None
 
-def play_audio(audio_segment):
-    """Play an audio segment."""
+# Raw PCM output lets audio go straight to the device without an ffmpeg decode; set mp3_44100_128 to get MP3 frames instead
+DEFAULT_OUTPUT_FORMAT = os.getenv("ELEVENLABS_OUTPUT_FORMAT", "pcm_24000")
+
+def get_output_format(voice_config):
+    """Return the TTS output format for a voice, e.g. 'pcm_24000' or 'mp3_44100_128'."""
+    return voice_config.get("output_format", DEFAULT_OUTPUT_FORMAT)
+
+def parse_output_format(output_format):
+    """Split an output format name into its codec and sample rate, e.g. ('pcm', 24000)."""
+    codec, sample_rate = output_format.split("_")[:2]
+    return codec, int(sample_rate)
+
+# Complete texts at least this long are split into segments synthesized over several TTS streams at once
+PARALLEL_TTS_MIN_CHARS = 400
+SEGMENT_MIN_CHARS = 200
+TTS_WORKERS = int(os.getenv("CMDGPT_TTS_WORKERS", "3"))
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+async def chunk_text_by_sentence(deltas, min_length=20):
+    """Regroup streamed text deltas into sentence or phrase sized chunks for TTS."""
+    buffer = ""
+    async for delta in deltas:
+        buffer += delta
+        parts = SENTENCE_BOUNDARY.split(buffer)
+        buffer = parts.pop()
+        pending = ""
+        for part in parts:
+            pending += part + " "
+            # Very short fragments ("Hi." or list markers) are merged into the next phrase
+            if len(pending.strip()) >= min_length:
+                yield pending
+                pending = ""
+        buffer = pending + buffer
+    if buffer.strip():
+        yield buffer + " "
+
+async def single_text_chunk(text):
+    """Wrap a complete text as a one-item async iterator."""
+    yield text + " "
+
+def websocket_is_open(websocket):
+    """Return True if the websocket connection is open."""
+    return websocket is not None and websocket.state.name == "OPEN"
+
+class TTSSession:
+    """A text-to-speech websocket kept open across turns for one voice.
+
+    Each reply is synthesized in its own context on the ElevenLabs multi-context
+    stream, so the connection, TLS and authentication handshakes happen once per
+    session instead of once per reply. Websocket pings keep the connection alive;
+    if the server still closes it (e.g. after its inactivity timeout), the next
+    reply reconnects transparently and the reconnects counter is incremented.
+    """
+
+    def __init__(self, voice_config, inactivity_timeout=180, ping_interval=20):
+        self.voice_config = voice_config
+        self.output_format = get_output_format(voice_config)
+        self.inactivity_timeout = inactivity_timeout
+        self.ping_interval = ping_interval
+        self.websocket = None
+        self.connected_once = False
+        self.reconnects = 0
+        self.turns = 0
+        # perf_counter() time at which the first audio of the latest reply arrived
+        self.first_audio_time = None
+        self.lock = asyncio.Lock()
+        # Extra sessions for synthesizing segments of a long text in parallel, opened on first use
+        self.helpers = []
+        # Timings of the segments of the latest text synthesized in parallel, in seconds from its start
+        self.segment_timings = []
+
+    @property
+    def uri(self):
+        return (f"{get_elevenlabs_websocket_url()}/v1/text-to-speech/{self.voice_config['voice_id']}/multi-stream-input"
+                f"?output_format={self.output_format}&inactivity_timeout={self.inactivity_timeout}")
+
+    async def connect(self):
+        """Open the websocket if it is not already open."""
+        if websocket_is_open(self.websocket):
+            return
+        if self.connected_once:
+            self.reconnects += 1
+            logging.info(f"Reconnecting TTS websocket for {self.voice_config['name']} (reconnect {self.reconnects})")
+        import websockets
+        headers = {"xi-api-key": os.getenv("ELEVENLABS_API_KEY")}
+        try:
+            self.websocket = await websockets.connect(self.uri, additional_headers=headers, ping_interval=self.ping_interval)
+        except TypeError:
+            # websockets releases before 14 name the argument extra_headers
+            self.websocket = await websockets.connect(self.uri, extra_headers=headers, ping_interval=self.ping_interval)
+        self.connected_once = True
+
+    async def start_context(self, context_id):
+        """Open a new synthesis context, reconnecting once if the socket was closed under us."""
+        message = json.dumps({
+            "text": " ",
+            "context_id": context_id,
+            "voice_settings": self.voice_config.get("voice_settings", {}),
+        })
+        await self.connect()
+        import websockets
+        try:
+            await self.websocket.send(message)
+        except websockets.ConnectionClosed:
+            self.websocket = None
+            await self.connect()
+            await self.websocket.send(message)
+
+    async def synthesize(self, text_chunks, before_audio_play_callback=None, play=True, on_audio=None, keep_audio=True,
+                         raise_errors=False):
+        """Feed text chunks to the TTS stream as they are produced and play audio as soon as it arrives.
+
+        The audio is written to an AudioSink as it arrives, which is returned for
+        saving, or None if there was no audio. With play=False the audio is only
+        collected, e.g. for saving in batch mode. If on_audio is given, it is awaited
+        with each audio chunk as it arrives; with keep_audio=False that is the only
+        place the audio goes. Errors are reported here and give None, unless
+        raise_errors is set, in which case they are raised to the caller.
+        """
+        async with self.lock:
+            self.turns += 1
+            context_id = f"turn{self.turns}"
+            codec, sample_rate = parse_output_format(self.output_format)
+            playback_job = None
+            sender = None
+            audio_sink = None
+            self.first_audio_time = None
+            try:
+                await self.start_context(context_id)
+                tracing.mark("tts_connect")
+                websocket = self.websocket
+
+                async def send_text():
+                    async for chunk in text_chunks:
+                        await websocket.send(json.dumps({"text": chunk, "context_id": context_id, "try_trigger_generation": True}))
+                    # Generate whatever is still buffered, then signal the end of this reply
+                    await websocket.send(json.dumps({"context_id": context_id, "flush": True}))
+                    await websocket.send(json.dumps({"context_id": context_id, "close_context": True}))
+
+                sender = asyncio.create_task(send_text())
+                if keep_audio:
+                    audio_sink = AudioSink(self.output_format)
+
+                # Receive, buffer and play the audio while text is still being sent
+                is_final = False
+                while not is_final:
+                    response = await websocket.recv()
+                    data = json.loads(response)
+                    if (data.get("contextId") or data.get("context_id")) not in (None, context_id):
+                        # Late frames from an earlier, abandoned reply
+                        continue
+                    if data.get("audio"):
+                        audio_data = base64.b64decode(data["audio"])
+                        if self.first_audio_time is None:
+                            self.first_audio_time = time.perf_counter()
+                            tracing.mark("first_audio_frame")
+                        tracing.add("audio_bytes", len(audio_data))
+                        # The decoded chunk is the only copy: the sink, on_audio and the player all get the same bytes
+                        if audio_sink is not None:
+                            audio_sink.write(audio_data)
+                        if on_audio:
+                            await on_audio(audio_data)
+                        if play and playback_job is None:
+                            # Call the callback right before playing audio
+                            if before_audio_play_callback:
+                                before_audio_play_callback()
+                            playback_job = get_audio_player(sample_rate).begin(codec, sample_rate)
+                        if playback_job is not None:
+                            # Feeding blocks while the playback buffer is full, so keep it off the event loop
+                            await asyncio.to_thread(playback_job.feed, audio_data)
+
+                    if data.get("isFinal"):
+                        is_final = True
+                await sender
+
+                if audio_sink is None or audio_sink.size == 0:
+                    return None
+                audio_sink.finish()
+                # Handed over to the caller, who saves or discards it
+                saved_sink, audio_sink = audio_sink, None
+                return saved_sink
+
+            except Exception as e:
+                if raise_errors:
+                    raise
+                logging.error(f"Error in stream_audio_websocket: {e}")
+                print(f"An error occurred in audio streaming: {e}")
+            finally:
+                if audio_sink is not None:
+                    audio_sink.discard()
+                if sender is not None:
+                    sender.cancel()
+                if playback_job is not None:
+                    playback_job.finish()
+
+    async def synthesize_text(self, text, before_audio_play_callback=None, play=True, on_audio=None, workers=TTS_WORKERS):
+        """Synthesize a complete text and return its audio as one AudioSink, or None if there was no audio.
+
+        Long texts are split into sentence or paragraph segments that are synthesized
+        over up to `workers` concurrent streams. Segments play strictly in order, each
+        as soon as the previous one has finished and its own audio is available. If a
+        segment fails, playback stops there and None is returned, so a clip with a
+        missing segment is never saved or cached.
+        """
+        segments = [segment async for segment in chunk_text_by_sentence(single_text_chunk(text), SEGMENT_MIN_CHARS)]
+        if len(text) < PARALLEL_TTS_MIN_CHARS or workers < 2 or len(segments) < 2:
+            return await self.synthesize(single_text_chunk(text), before_audio_play_callback, play, on_audio)
+
+        while len(self.helpers) < workers - 1:
+            self.helpers.append(TTSSession(self.voice_config, self.inactivity_timeout, self.ping_interval))
+        idle_sessions = asyncio.Queue()
+        for session in [self, *self.helpers]:
+            idle_sessions.put_nowait(session)
+        segment_audio = [asyncio.Queue() for _ in segments]
+        timings = [{"segment": index, "chars": len(segment)} for index, segment in enumerate(segments)]
+        start = time.perf_counter()
+
+        async def synthesize_segment(index, segment):
+            # Sessions are handed out in segment order, so earlier segments never wait on later ones
+            session = await idle_sessions.get()
+            timings[index]["started"] = time.perf_counter() - start
+
+            async def collect(audio_data):
+                timings[index].setdefault("first_audio", time.perf_counter() - start)
+                segment_audio[index].put_nowait(audio_data)
+
+            try:
+                await session.synthesize(single_text_chunk(segment), play=False, on_audio=collect, keep_audio=False,
+                                         raise_errors=True)
+                timings[index]["synthesized"] = time.perf_counter() - start
+            finally:
+                segment_audio[index].put_nowait(None)
+                idle_sessions.put_nowait(session)
+
+        tasks = [asyncio.create_task(synthesize_segment(index, segment)) for index, segment in enumerate(segments)]
+        codec, sample_rate = parse_output_format(self.output_format)
+        playback_job = None
+        audio_sink = AudioSink(self.output_format)
+        try:
+            for index, audio_queue in enumerate(segment_audio):
+                segment_start = audio_sink.size
+                while (audio_data := await audio_queue.get()) is not None:
+                    audio_sink.write(audio_data)
+                    if on_audio:
+                        await on_audio(audio_data)
+                    if play and playback_job is None:
+                        if before_audio_play_callback:
+                            before_audio_play_callback()
+                        playback_job = get_audio_player(sample_rate).begin(codec, sample_rate)
+                    if playback_job is not None:
+                        await asyncio.to_thread(playback_job.feed, audio_data)
+                # Raises if this segment failed, before any later segment is played
+                await tasks[index]
+                timings[index]["bytes"] = audio_sink.size - segment_start
+                timings[index]["queued_for_playback"] = time.perf_counter() - start
+        except Exception as e:
+            audio_sink.discard()
+            logging.error(f"Error in synthesize_text: {e}")
+            print(f"An error occurred in audio streaming: {e}")
+            return None
+        except BaseException:
+            audio_sink.discard()
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            if playback_job is not None:
+                playback_job.finish()
+        self.segment_timings = timings
+        logging.debug(f"Synthesized {len(segments)} segments with {workers} streams: {timings}")
+
+        if audio_sink.size == 0:
+            audio_sink.discard()
+            return None
+        audio_sink.finish()
+        return audio_sink
+
+    async def close(self):
+        """Close the websocket and those of the helper sessions."""
+        for helper in self.helpers:
+            await helper.close()
+        self.helpers = []
+        if websocket_is_open(self.websocket):
+            import websockets
+            try:
+                await self.websocket.send(json.dumps({"close_socket": True}))
+                await self.websocket.close()
+            except websockets.ConnectionClosed:
+                pass
+        self.websocket = None
+        logging.info(f"TTS session for {self.voice_config['name']} closed after {self.turns} turns and {self.reconnects} reconnects")
+
+AUDIO_READ_BYTES = 64 * 1024
+
+async def play_audio_file(path, output_format):
+    """Play already synthesized audio, e.g. from the cache, through the shared player.
+
+    The file is read a block at a time into a new AudioSink, which is returned for saving.
+    """
+    codec, sample_rate = parse_output_format(output_format)
+    audio_sink = AudioSink(output_format)
+    playback_job = get_audio_player(sample_rate).begin(codec, sample_rate)
+    try:
+        with open(path, "rb") as file:
+            while audio_data := await asyncio.to_thread(file.read, AUDIO_READ_BYTES):
+                audio_sink.write(audio_data)
+                await asyncio.to_thread(playback_job.feed, audio_data)
+    except BaseException:
+        audio_sink.discard()
+        raise
+    finally:
+        playback_job.finish()
+    audio_sink.finish()
+    return audio_sink
+
+async def stream_text_audio_websocket(voice_config, text_chunks, before_audio_play_callback=None):
+    """Synthesize and play text chunks over a one-off TTS connection."""
+    session = TTSSession(voice_config)
     try:
-        p = pyaudio.PyAudio()
-        stream = p.open(format=p.get_format_from_width(audio_segment.sample_width),
-                        channels=audio_segment.channels,
-                        rate=audio_segment.frame_rate,
-                        output=True)
-        stream.write(audio_segment.raw_data)
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-    except Exception as e:
-        print(f"Error while playing audio: {e}")
-
-async def stream_audio_websocket(voice_config, text, before_audio_play_callback):
-    uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{voice_config['voice_id']}/stream-input"
+        return await session.synthesize(text_chunks, before_audio_play_callback)
+    finally:
+        await session.close()
+
+async def stream_audio_websocket(voice_config, text, before_audio_play_callback=None):
+    """Convert a complete text to speech and play it, synthesizing long texts in parallel segments."""
+    session = TTSSession(voice_config)
     try:
-        async with websockets.connect(uri) as websocket:
-            # Send initial settings
-            await websocket.send(json.dumps({
-                "text": " ",
-                "voice_settings": voice_config.get("voice_settings", {}),
-                "xi_api_key": os.getenv("ELEVENLABS_API_KEY"),
-            }))
-
-            # Send the text for TTS conversion
-            await websocket.send(json.dumps({"text": text + " ", "try_trigger_generation": True}))
-
-            # Signal end of input
-            await websocket.send(json.dumps({"text": ""}))
-
-            # Initialize a large audio buffer
-            audio_buffer = BytesIO()
-
-            # Receive and buffer the audio
-            is_final = False
-            while not is_final:
-                response = await websocket.recv()
-                data = json.loads(response)
-                if data.get("audio"):
-                    audio_data = base64.b64decode(data["audio"])
-                    audio_buffer.write(audio_data)
-
-                if data.get("isFinal"):
-                    is_final = True
-
-            # Call the callback right before playing audio
-            before_audio_play_callback()
-
-            audio_buffer.seek(0)
-            audio_segment = AudioSegment.from_mp3(audio_buffer)
-
-            # Play audio in a new thread
-            audio_thread = threading.Thread(target=play_audio, args=(audio_segment,))
-            audio_thread.start()
-
-            return audio_buffer
-
-    except Exception as e:
-        logging.error(f"Error in stream_audio_websocket: {e}")
-        print(f"An error occurred in audio streaming: {e}")
\ No newline at end of file
+        return await session.synthesize_text(text, before_audio_play_callback)
+    finally:
+        await session.close()